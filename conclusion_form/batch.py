@@ -0,0 +1,89 @@
+import os
+import re
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from conclusion_form import render
+
+
+def conclusion_filename(save_dir, name, taken):
+    """«<ФИО> - заключение.docx» в save_dir; однофамильцам в одной пачке — « (2)», « (3)»…"""
+    base = re.sub(r'[\\\/\:\*\?"<>\|]', '_', name.strip()) or "без имени"
+    filename = f"{base} - заключение.docx"
+    n = 1
+    while filename.lower() in taken:
+        n += 1
+        filename = f"{base} ({n}) - заключение.docx"
+    taken.add(filename.lower())
+    return os.path.join(save_dir, filename)
+
+
+def render_to_file(template_file, data_dict, out_path):
+    """
+    Выполняется в процессе пула: шаблон разбирается один раз на процесс (render.get_template),
+    дальше каждое заключение собирается прямо из кусков document.xml (render.OoxmlTemplate).
+    """
+    render.get_template(template_file, render.OoxmlTemplate).save(data_dict, out_path)
+    return out_path
+
+
+class BatchRun:
+    """
+    Пакетная выдача заключений в пуле процессов.
+    tasks — [(шаблон, поля для подстановки, путь к .docx)]. Окно опрашивает poll()
+    по таймеру (after), cancel() снимает ещё не начатые задачи; уже запущенные дорабатывают.
+    """
+
+    def __init__(self, tasks, max_workers=None):
+        self.tasks = tasks
+        self.max_workers = max_workers
+        self.executor = None
+        self.futures = []
+        self.cancelled = False
+        # номер задачи -> None (готово) или текст ошибки
+        self.results = {}
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self.futures = [self.executor.submit(render_to_file, *task) for task in self.tasks]
+
+    def poll(self):
+        """(обработано, всего); собирает результаты завершившихся задач."""
+        for i, future in enumerate(self.futures):
+            if i in self.results or not future.done():
+                continue
+            if future.cancelled():
+                self.results[i] = "отменено"
+                continue
+            exc = future.exception()
+            self.results[i] = None if exc is None else str(exc)
+        return len(self.results), len(self.tasks)
+
+    @property
+    def finished(self):
+        return self.executor is not None and len(self.results) == len(self.tasks)
+
+    def cancel(self):
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    def succeeded(self):
+        """Номера задач, заключения по которым записаны."""
+        return [i for i, error in sorted(self.results.items()) if error is None]
+
+    def failed(self):
+        return [(i, error) for i, error in sorted(self.results.items()) if error and error != "отменено"]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def build_tasks(values_list, exam_type, template_file, save_dir):
+    """Задачи BatchRun для записей (словари полей записи, как для RecordRepository.save)."""
+    taken = set()
+    year = str(datetime.datetime.now().year)
+    return [(template_file, render.conclusion_data(values, exam_type, year),
+             conclusion_filename(save_dir, values.get("name", ""), taken))
+            for values in values_list]
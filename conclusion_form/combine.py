@@ -0,0 +1,150 @@
+import os
+import time
+
+from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docxcompose.composer import Composer
+from docxcompose.utils import xpath
+
+
+class IncrementalComposer(Composer):
+    """
+    Composer, который после добавления документа перенумеровывает закладки и id рисунков
+    только в добавленных элементах тела (и в колонтитулах — они невелики), с тем же
+    результатом, что у Composer. Обычный Composer каждый раз обходит всё тело
+    объединённого документа, и сотое добавление стоит в десятки раз дороже первого.
+    """
+
+    def __init__(self, doc):
+        super().__init__(doc)
+        # (позиция вставки, длина тела до вставки) для текущего append
+        self._appending = None
+        self._next_bookmark = None
+        self._next_docpr = None
+        self._next_nvpicpr = None
+
+    def append(self, doc, remove_property_fields=True):
+        index = self.append_index()
+        self._appending = (index, len(self.doc.element.body))
+        try:
+            self.insert(index, doc, remove_property_fields=remove_property_fields)
+        finally:
+            self._appending = None
+
+    def _new_elements(self):
+        """Элементы тела, вставленные текущим append, или None — тогда нумеруем как обычно."""
+        if self._appending is None:
+            return None
+        index, before = self._appending
+        body = self.doc.element.body
+        return body[index:index + len(body) - before]
+
+    def renumber_bookmarks(self):
+        new = self._new_elements()
+        if new is None or self._next_bookmark is None:
+            super().renumber_bookmarks()
+            self._next_bookmark = len(xpath(self.doc.element.body, ".//w:bookmarkStart"))
+            return
+        w_id = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id"
+        start_id = end_id = self._next_bookmark
+        for element in new:
+            for bookmark in xpath(element, ".//w:bookmarkStart"):
+                bookmark.set(w_id, str(start_id))
+                start_id += 1
+            for bookmark in xpath(element, ".//w:bookmarkEnd"):
+                bookmark.set(w_id, str(end_id))
+                end_id += 1
+        self._next_bookmark = start_id
+
+    def renumber_docpr_ids(self):
+        self._next_docpr = self._renumber_ids(".//wp:docPr", self._next_docpr, super().renumber_docpr_ids)
+
+    def renumber_nvpicpr_ids(self):
+        self._next_nvpicpr = self._renumber_ids(".//pic:cNvPr", self._next_nvpicpr, super().renumber_nvpicpr_ids)
+
+    def _renumber_ids(self, path, next_id, renumber_all):
+        """
+        Нумерация как у Composer: сначала id по порядку в теле, затем в колонтитулах.
+        Новые элементы стоят в конце тела и получают id после уже выданных; колонтитулы
+        (в них единицы рисунков) перенумеровываются после тела каждый раз, включая
+        добавленные fix_header_and_footers. Возвращает следующий id тела.
+        """
+        new = self._new_elements()
+        if new is None or next_id is None:
+            renumber_all()
+            return len(xpath(self.doc.element.body, path)) + 1
+        for element in new:
+            for e in xpath(element, path):
+                e.id = next_id
+                next_id += 1
+        header_id = next_id
+        for part in self._header_footer_parts():
+            for e in xpath(part.element, path):
+                e.id = header_id
+                header_id += 1
+        return next_id
+
+    def _header_footer_parts(self):
+        return [rel.target_part for rel in self.doc.part.rels.values()
+                if rel.reltype in (RT.HEADER, RT.FOOTER)]
+
+
+class DocumentCombiner:
+    """
+    Объединённый файл за день, открытый на весь сеанс работы формы.
+    Заключения добавляются в документ в памяти (без временных файлов и без
+    перечитывания файла). На диск он записывается flush(): форма вызывает его, когда файл
+    только создан, когда накопилось FLUSH_EVERY заключений (due), по таймеру и при close().
+    Запись отделена от append, чтобы ошибка записи не приводила к повторному добавлению.
+    Если файл изменили снаружи, а несохранённых добавлений нет, он открывается заново.
+    """
+
+    FLUSH_EVERY = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.composer = None
+        self.pending = 0
+        self.stamp = None
+
+    def _disk_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def append(self, doc):
+        """Добавляет документ; возвращает True, если файл создаётся этим добавлением."""
+        created = False
+        if self.composer is None or (not self.pending and self._disk_stamp() != self.stamp):
+            if os.path.exists(self.path):
+                self.composer = IncrementalComposer(Document(self.path))
+                self.composer.append(doc)
+            else:
+                # первое заключение дня само становится основой файла
+                self.composer = IncrementalComposer(doc)
+                created = True
+        else:
+            self.composer.append(doc)
+        self.pending += 1
+        return created
+
+    @property
+    def due(self):
+        """Накопилось FLUSH_EVERY несохранённых заключений — пора записать файл."""
+        return self.pending >= self.FLUSH_EVERY
+
+    def flush(self):
+        """Записывает накопленное; при ошибке (файл открыт в Word) добавления не теряются."""
+        if self.composer is None or not self.pending:
+            return
+        started = time.perf_counter()
+        self.composer.save(self.path)
+        self.pending = 0
+        self.stamp = self._disk_stamp()
+        print(f"Объединённый файл записан за {(time.perf_counter() - started) * 1000:.0f} мс: {self.path}")
+
+    def close(self):
+        self.flush()
+        self.composer = None
@@ -1,21 +1,23 @@
 import tkinter as tk
-from tkinter import messagebox, BooleanVar
-from tkinter.ttk import Combobox
+from tkinter import messagebox, filedialog, BooleanVar
+from tkinter.ttk import Combobox, Progressbar
 from tkcalendar import Calendar
 import datetime
-import xml.etree.ElementTree as ET
-from docx import Document
-from docxcompose.composer import Composer
-import tempfile
-import shutil
 import re
-import xml.dom.minidom as minidom
 import ctypes
 from ctypes import wintypes
 import calendar
+import heapq
+import time
 
 import sys, os, json
 
+from conclusion_form import storage
+from conclusion_form import roster_import
+from conclusion_form import render
+from conclusion_form import batch
+from conclusion_form import combine
+
 APP_NAME = "Medoctor"
 
 
@@ -56,12 +58,106 @@ CALENDAR_PNG  = resource_path("conclusion_form/res/calendar.png")
 PRIKAZ_XLSX   = resource_path("search_form/input/prikaz29n.xlsx")
 SUMMER_XLSX   = resource_path("search_form/input/summer.xlsx")
 
+# Сколько совпадений показывать в выпадающем списке при живом поиске
+FILTER_LIMIT = 100
+
+# Подсказки ФИО: пауза после последней клавиши, сколько имён показывать,
+# и порог времени поиска и отрисовки (без паузы), выше которого замер пишется в лог сразу
+SUGGEST_DELAY_MS = 120
+SUGGEST_LIMIT = 10
+SUGGEST_SLOW_MS = 50
+
+# Объединённый файл дня пишется на диск после паузы в работе (и каждые DocumentCombiner.FLUSH_EVERY заключений)
+COMBINE_FLUSH_MS = 30000
+
+
+class SubstringIndex:
+    """
+    Поиск подстроки в списке значений выпадающего списка.
+    Значения приводятся storage.fold_name один раз; для каждой тройки символов хранится
+    множество номеров значений, где она встречается. Запрос от трёх символов —
+    пересечение этих множеств и проверка кандидатов; короче — просмотр готовых ключей.
+    """
+
+    def __init__(self, values=()):
+        self._reset()
+        self.update(values)
+
+    def _reset(self):
+        self._values = []
+        self._keys = []
+        self._ids = {}
+        self._grams = {}
+
+    def update(self, values):
+        """
+        Приводит индекс к списку уникальных values: новые значения досчитываются,
+        а если каких-то уже нет (данные перечитаны с диска) — индекс строится заново.
+        """
+        for value in values:
+            if value not in self._ids:
+                self._add(value)
+        if len(self._ids) > len(values):
+            self._reset()
+            for value in values:
+                self._add(value)
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def add(self, value):
+        """Добавляет одно значение (например, из только что сохранённой записи)."""
+        if value not in self._ids:
+            self._add(value)
+
+    def _add(self, value):
+        pos = len(self._values)
+        key = storage.fold_name(value)
+        self._ids[value] = pos
+        self._values.append(value)
+        self._keys.append(key)
+        for i in range(len(key) - 2):
+            self._grams.setdefault(key[i:i + 3], set()).add(pos)
+
+    def search(self, text, limit=100):
+        """
+        До limit значений, содержащих text: сначала начинающиеся с него,
+        затем остальные, внутри групп — по алфавиту.
+        """
+        query = storage.fold_name(text)
+        keys = self._keys
+        if len(query) < 3:
+            found = [pos for pos, key in enumerate(keys) if query in key]
+        else:
+            postings = []
+            for i in range(len(query) - 2):
+                posting = self._grams.get(query[i:i + 3])
+                if not posting:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+            found = [pos for pos in set.intersection(*postings) if query in keys[pos]]
+        ranked = heapq.nsmallest(limit, found, key=lambda pos: (not keys[pos].startswith(query), keys[pos]))
+        return [self._values[pos] for pos in ranked]
+
+
 class ConclusionForm(tk.Frame):
     def __init__(self, parent, main_app):
         super().__init__(parent)
         self.main_app = main_app
         self.settings = main_app.settings
-        self.suggestion_listbox = None
+        # одно окно подсказок на всё время работы: создаётся при первом показе, потом только прячется
+        self.suggestion_popup = None
+        self.suggestion_lb = None
+        self._suggest_job = None
+        self._suggest_seq = 0
+        self._suggest_keystroke = None
+        self.suggest_latencies = []
+        # «Объединить все в один файл»: документ дня открыт весь сеанс (combine.DocumentCombiner)
+        self.combiner = None
+        self._combine_flush_job = None
+        # (поле, организация) -> SubstringIndex для живого поиска в combobox'ах
+        self.search_indexes = {}
         self.report_org_window = None
         self.report_month_window = None
 
@@ -76,7 +172,8 @@ class ConclusionForm(tk.Frame):
         self.diagnosis = tk.StringVar()
         self.combine_all = BooleanVar(value=False)
 
-        # Данные из XML
+        # Общий с отчётами кэш записей (data.xml или SQLite — по настройке storage_backend)
+        self.store = storage.get_repository(USER_XML_PATH, self.settings.get("storage_backend", "xml"))
         self.data = self.load_data()
 
         # --- UI ---
@@ -121,7 +218,8 @@ class ConclusionForm(tk.Frame):
         self.name_entry = tk.Entry(self, width=53)
         self.name_entry.grid(row=row, column=1, padx=10)
         self.name_entry.bind("<FocusOut>", lambda e: self.sex_var.set(self.detect_sex_from_name(self.name_entry.get())))
-        self.name_entry.bind("<KeyRelease>", self.show_name_suggestions)
+        self.name_entry.bind("<KeyRelease>", self.schedule_name_suggestions)
+        self.name_entry.bind("<Escape>", lambda e: self.hide_name_suggestions())
 
         row += 1
         tk.Label(self, text="Дата рождения").grid(row=row, column=0, sticky="w", padx=10, pady=(10, 0))
@@ -143,6 +241,13 @@ class ConclusionForm(tk.Frame):
         self.sex_cb = Combobox(self, textvariable=self.sex_var, values=["М", "Ж"], width=50, state="readonly")
         self.sex_cb.grid(row=row, column=1, padx=10)
 
+        row += 1
+        tk.Label(self, text="Прошлые осмотры").grid(row=row, column=0, sticky="nw", padx=10, pady=(10, 0))
+        self.visits_lb = tk.Listbox(self, width=53, height=3, exportselection=False)
+        self.visits_lb.grid(row=row, column=1, padx=10, pady=(10, 0))
+        self.visits_lb.bind("<Double-Button-1>", self.on_visit_selected)
+        self.shown_visits = []
+
         row += 1
         tk.Label(self, text="Подразделение").grid(row=row, column=0, sticky="w", padx=10, pady=(10, 0))
         self.division_cb = Combobox(self, textvariable=self.division, width=50)
@@ -174,6 +279,12 @@ class ConclusionForm(tk.Frame):
         self.create_btn = tk.Button(self, text="Создать документ", command=self.generate_document, bg="#4CAF50", fg="white", height=2)
         self.create_btn.grid(row=row, column=0, columnspan=2, padx=10, pady=20, sticky="ew")
 
+        row += 1
+        tk.Button(self, text="Импорт списка…", command=self.import_roster).grid(
+            row=row, column=0, padx=10, pady=(0, 10), sticky="ew")
+        tk.Button(self, text="Пакетная выдача…", command=self.open_batch_window).grid(
+            row=row, column=1, padx=10, pady=(0, 10), sticky="ew")
+
         row += 1
         self.combine_all = tk.BooleanVar(value=True)
         tk.Checkbutton(
@@ -196,8 +307,7 @@ class ConclusionForm(tk.Frame):
         self.notification_label.place_forget()
 
         # Автозаполнение
-        self.organization_cb['values'] = sorted(self.data.keys())
-        self.organization_cb.all_values = list(self.organization_cb['values'])
+        self.set_combobox_values(self.organization_cb, "organization", self.store.organizations())
 
         for cb in (self.organization_cb, self.division_cb, self.profession_cb, self.factors_cb, self.typework_cb):
             cb.bind('<KeyRelease>', self.on_keyrelease)
@@ -209,23 +319,37 @@ class ConclusionForm(tk.Frame):
     def sanitize_filename(name: str) -> str:
         return re.sub(r'[\\\/\:\*\?"<>\|]', '_', name)
 
-    def show_name_suggestions(self, event):
-        if self.suggestion_listbox:
-            self.suggestion_listbox.destroy()
-            self.suggestion_listbox = None
-
-        text = self.name_entry.get().strip().lower()
-        if not text:
+    def schedule_name_suggestions(self, event):
+        """
+        Откладывает подсказки на SUGGEST_DELAY_MS: при быстром наборе предыдущий
+        отложенный запрос отменяется, и ищется только последний текст.
+        """
+        if event.keysym in ("Escape", "Return", "Tab"):
             return
-
-        all_names = []
-        for records in self.data.values():
-            for rec in records:
-                fio = rec.get("name", "")
-                if fio and fio.lower().startswith(text):
-                    all_names.append(fio)
-        suggestions = sorted(set(all_names))[:10]
+        # время от последней клавиши серии — после неё пользователь ждёт подсказку
+        self._suggest_keystroke = time.perf_counter()
+        if self._suggest_job is not None:
+            self.after_cancel(self._suggest_job)
+        self._suggest_seq += 1
+        self._suggest_job = self.after(SUGGEST_DELAY_MS, self.show_name_suggestions, self._suggest_seq)
+
+    def show_name_suggestions(self, seq=None):
+        self._suggest_job = None
+        if seq is not None and seq != self._suggest_seq:
+            return  # после этого запроса уже был ввод
+        last_key = self._suggest_keystroke
+        self._suggest_keystroke = None
+        # поиск и заполнение списка замеряем отдельно от паузы SUGGEST_DELAY_MS
+        started = time.perf_counter()
+
+        text = self.name_entry.get().strip()
+        suggestions = self.store.suggest_names(text, SUGGEST_LIMIT) if text else []
+        if not suggestions and text:
+            # по началу ничего — возможно, опечатка в фамилии или латинские буквы
+            suggestions = self.store.fuzzy_names(text, SUGGEST_LIMIT)
         if not suggestions:
+            self.hide_name_suggestions()
+            self.record_suggest_latency(started, last_key)
             return
 
         x = self.name_entry.winfo_rootx()
@@ -233,46 +357,105 @@ class ConclusionForm(tk.Frame):
         w = self.name_entry.winfo_width()
         h = min(200, len(suggestions) * 20)
 
-        self.suggestion_listbox = tk.Toplevel(self)
-        self.suggestion_listbox.overrideredirect(True)
-        self.suggestion_listbox.transient(self)
-        self.suggestion_listbox.geometry(f"{w}x{h}+{x}+{y}")
-        self.suggestion_listbox.lift()
-
-        lb = tk.Listbox(self.suggestion_listbox, exportselection=False)
-        lb.pack(fill="both", expand=True)
-        for item in suggestions:
-            lb.insert(tk.END, item)
-
-        def on_select(evt):
-            sel = lb.get(lb.curselection())
-            self.suggestion_listbox.destroy()
-            self.suggestion_listbox = None
-            self.fill_person_fields(sel)
-            self.focus_force()
-        lb.bind("<ButtonRelease-1>", on_select)
+        if self.suggestion_popup is None:
+            self.suggestion_popup = tk.Toplevel(self)
+            self.suggestion_popup.overrideredirect(True)
+            self.suggestion_popup.transient(self)
+            self.suggestion_lb = tk.Listbox(self.suggestion_popup, exportselection=False)
+            self.suggestion_lb.pack(fill="both", expand=True)
+            self.suggestion_lb.bind("<ButtonRelease-1>", self.on_name_suggestion_selected)
+
+        lb = self.suggestion_lb
+        lb.delete(0, tk.END)
+        lb.insert(tk.END, *suggestions)
+        self.suggestion_popup.geometry(f"{w}x{h}+{x}+{y}")
+        self.suggestion_popup.deiconify()
+        self.suggestion_popup.lift()
+
+        self.suggestion_popup.update_idletasks()
+        self.record_suggest_latency(started, last_key)
+
+    def record_suggest_latency(self, started, last_key=None):
+        """
+        Замер подсказок: поиск и заполнение списка (от started) и, если известна,
+        задержка от последней клавиши до отрисовки (с паузой SUGGEST_DELAY_MS).
+        """
+        now = time.perf_counter()
+        work_ms = (now - started) * 1000
+        self.suggest_latencies.append(work_ms)
+        if work_ms > SUGGEST_SLOW_MS:
+            waited = f", {(now - last_key) * 1000:.0f} мс от клавиши" if last_key is not None else ""
+            print(f"Подсказки ФИО: медленно, поиск и отрисовка {work_ms:.0f} мс{waited}")
+        if len(self.suggest_latencies) >= 50:
+            values = sorted(self.suggest_latencies)
+            print(f"Подсказки ФИО, последние {len(values)}: поиск и отрисовка — медиана "
+                  f"{values[len(values) // 2]:.0f} мс, максимум {values[-1]:.0f} мс "
+                  f"(плюс пауза {SUGGEST_DELAY_MS} мс после клавиши)")
+            self.suggest_latencies = []
+
+    def hide_name_suggestions(self):
+        if self._suggest_job is not None:
+            self.after_cancel(self._suggest_job)
+            self._suggest_job = None
+        self._suggest_keystroke = None
+        if self.suggestion_popup is not None:
+            self.suggestion_popup.withdraw()
+
+    def on_name_suggestion_selected(self, event):
+        selection = self.suggestion_lb.curselection()
+        if not selection:
+            return
+        sel = self.suggestion_lb.get(selection[0])
+        self.hide_name_suggestions()
+        self.fill_person_fields(sel)
+        self.focus_force()
 
     def fill_person_fields(self, fio):
-        for records in self.data.values():
-            for rec in records:
-                if rec.get("name") == fio:
-                    self.name_entry.delete(0, tk.END)
-                    self.name_entry.insert(0, rec["name"])
-                    self.birthday_entry.delete(0, tk.END)
-                    self.birthday_entry.insert(0, rec["birthday"])
-                    self.sex_var.set(rec["sex"])
-                    self.ids_entry.delete(0, tk.END)
-                    self.ids_entry.insert(0, rec.get("ids_date", ""))
-                    return
+        """Заполняет форму по последнему осмотру человека и показывает список его осмотров."""
+        visits = self.store.visits(fio)
+        if not visits:
+            return
+        org_name, rec = visits[-1]
+        self.fill_from_visit(org_name, rec)
+        self.show_previous_visits(self.store.visits(rec.name, rec.birthday))
+
+    def fill_from_visit(self, org_name, rec):
+        self.name_entry.delete(0, tk.END)
+        self.name_entry.insert(0, rec["name"])
+        self.birthday_entry.delete(0, tk.END)
+        self.birthday_entry.insert(0, rec["birthday"])
+        self.sex_var.set(rec["sex"])
+        self.ids_entry.delete(0, tk.END)
+        self.ids_entry.insert(0, rec.get("ids_date", ""))
+        if org_name:
+            self.organization.set(org_name)
+            self.update_comboboxes()
+        self.division.set(rec.get("division", ""))
+        self.profession.set(rec.get("profession", ""))
+        self.factors.set(rec.get("factors", ""))
+        self.typework.set(rec.get("typework", ""))
+
+    def show_previous_visits(self, visits):
+        """Список осмотров, новые сверху; двойной щелчок заполняет форму по выбранному."""
+        self.shown_visits = list(reversed(visits))
+        self.visits_lb.delete(0, tk.END)
+        for org_name, rec in self.shown_visits:
+            line = " — ".join(v for v in (rec.get("ids_date", "") or "без даты", org_name, rec.get("profession", "")) if v)
+            self.visits_lb.insert(tk.END, line)
+
+    def on_visit_selected(self, event):
+        selection = self.visits_lb.curselection()
+        if selection:
+            self.fill_from_visit(*self.shown_visits[selection[0]])
 
     @staticmethod
     def detect_sex_from_name(full_name):
         parts = full_name.strip().split()
         if len(parts) >= 3:
             middle = parts[2].lower()
-            if middle.endswith(("вич", "льич", "ич")):
+            if middle.endswith(roster_import.MALE_PATRONYMIC_SUFFIXES):
                 return "М"
-            elif middle.endswith(("вна", "чна", "инична", "овна", "евна", "ична")):
+            elif middle.endswith(roster_import.FEMALE_PATRONYMIC_SUFFIXES):
                 return "Ж"
         return "М"
 
@@ -298,115 +481,237 @@ class ConclusionForm(tk.Frame):
         self.typework.set("")
         self.diagnosis.set("")
         self.ids_entry.delete(0, tk.END)
+        self.show_previous_visits([])
 
     def load_data(self):
-        if not os.path.exists(USER_XML_PATH):
-            return {}
-        tree = ET.parse(USER_XML_PATH)
-        root = tree.getroot()
-        data = {}
-        for person in root.findall("person"):
-            org_name = person.findtext("organization", default="")
-            record = {
-                "name": person.findtext("name", default=""),
-                "birthday": person.findtext("birthday", default=""),
-                "sex": person.findtext("sex", default=""),
-                "division": person.findtext("division", default=""),
-                "profession": person.findtext("profession", default=""),
-                "factors": person.findtext("factors", default=""),
-                "typework": person.findtext("typework", default=""),
-                "id": person.findtext("id", default=""),
-                "ids_date": person.findtext("ids_date", default=""),
-                "diagnosis": person.findtext("diagnosis", default="")
-            }
-            if org_name not in data:
-                data[org_name] = []
-            data[org_name].append(record)
-        return data
-
-    def prettify_xml(self, xml_path):
-        xml_str = open(xml_path, "r", encoding="utf-8").read()
-        dom = minidom.parseString(xml_str)
-        pretty_xml = dom.toprettyxml(indent="  ", encoding="utf-8")
-        with open(xml_path, "wb") as f:
-            f.write(pretty_xml)
+        return self.store.load_data()
 
     def save_record(self, org_name, division, profession, factors, typework,
                     name=None, birthday=None, sex_val=None, diagnosis=None, ids_date=None):
         if not (name and birthday and sex_val):
             return
-        if os.path.exists(USER_XML_PATH):
-            tree = ET.parse(USER_XML_PATH)
-            root = tree.getroot()
-        else:
-            root = ET.Element("data")
-            tree = ET.ElementTree(root)
+        existing = self.store.find_visit(name, birthday, ids_date)
+        if existing:
+            # generate_document уже спросил оператора; здесь — на случай других вызовов
+            print(f"Осмотр уже сохранён (id={existing[1].id}), повторно не записываем: {name} {birthday} {ids_date}")
+            return
         now_str = datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-        p = ET.SubElement(root, "person")
-        ET.SubElement(p, "organization").text = org_name
-        ET.SubElement(p, "name").text = name
-        ET.SubElement(p, "birthday").text = birthday
-        ET.SubElement(p, "sex").text = sex_val
-        ET.SubElement(p, "division").text = division
-        ET.SubElement(p, "profession").text = profession
-        ET.SubElement(p, "factors").text = factors
-        ET.SubElement(p, "typework").text = typework
-        ET.SubElement(p, "diagnosis").text = diagnosis if diagnosis else ""
-        ET.SubElement(p, "ids_date").text = ids_date if ids_date else ""
-        ET.SubElement(p, "id").text = str(int(datetime.datetime.now().timestamp()))
-        ET.SubElement(p, "date_created").text = now_str
-        tree.write(USER_XML_PATH, encoding="utf-8", xml_declaration=True)
-        self.prettify_xml(USER_XML_PATH)
-
-    def get_unique_values(self, field, org_name=None):
-        """Вернёт уникальные значения поля. Если задана org_name — только для этой организации."""
-        values = set()
-
-        if org_name and org_name in self.data:
-            records = self.data[org_name]
-        else:
-            # все записи по всем организациям
-            records = [rec for recs in self.data.values() for rec in recs]
-
-        for record in records:
-            val = record.get(field)
-            if val:
-                values.add(val)
+        values = {
+            "organization": org_name,
+            "name": name,
+            "birthday": birthday,
+            "sex": sex_val,
+            "division": division,
+            "profession": profession,
+            "factors": factors,
+            "typework": typework,
+            "diagnosis": diagnosis if diagnosis else "",
+            "ids_date": ids_date if ids_date else "",
+            "date_created": now_str,
+        }
+        self.store.save(values)
+        return values
+
+    def import_roster(self):
+        """Загрузка списка работников (xlsx/csv); пустые организация и дата ИДС берутся из формы."""
+        path = filedialog.askopenfilename(
+            parent=self,
+            title="Список работников",
+            filetypes=[("Списки", "*.xlsx *.xls *.csv"), ("Все файлы", "*.*")]
+        )
+        if not path:
+            return
+        defaults = {
+            "organization": self.organization.get().strip(),
+            "ids_date": self.ids_entry.get().strip(),
+        }
+        try:
+            saved, errors_path = roster_import.import_roster(path, self.store, defaults)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось загрузить список:\n{e}")
+            return
 
-        return sorted(values)
+        self.data = self.load_data()
+        self.update_comboboxes()
+        self.show_notification(f"Загружено записей: {len(saved)}")
+        if errors_path:
+            messagebox.showwarning(
+                "Импорт списка",
+                f"Часть строк не загружена, подробности в файле:\n{errors_path}"
+            )
 
-    def replace_placeholders(self, doc, data_dict):
-        def replace_in_paragraph(paragraph, data_dict):
-            text = ''.join(run.text for run in paragraph.runs)
-            parts = re.split(r'(\{.*?\})', text)
-            if not any(part in data_dict for part in parts):
+    def open_batch_window(self):
+        """Пакетная выдача: заключения по списку работников или по записям организации за период."""
+        win = tk.Toplevel(self)
+        win.title("Пакетная выдача заключений")
+        win.resizable(False, False)
+        padx, pady = 10, 5
+
+        source_var = tk.StringVar(value="roster")
+        tk.Radiobutton(win, text="Список работников (xlsx/csv)", variable=source_var, value="roster").grid(
+            row=0, column=0, columnspan=3, sticky="w", padx=padx, pady=pady)
+        path_var = tk.StringVar()
+        tk.Entry(win, textvariable=path_var, width=40).grid(row=1, column=0, columnspan=2, sticky="w", padx=padx)
+
+        def choose_roster():
+            path = filedialog.askopenfilename(
+                parent=win,
+                title="Список работников",
+                filetypes=[("Списки", "*.xlsx *.xls *.csv"), ("Все файлы", "*.*")]
+            )
+            if path:
+                path_var.set(path)
+                source_var.set("roster")
+        tk.Button(win, text="Выбрать...", command=choose_roster).grid(row=1, column=2, padx=padx)
+
+        tk.Radiobutton(win, text="Записи из базы за период", variable=source_var, value="store").grid(
+            row=2, column=0, columnspan=3, sticky="w", padx=padx, pady=(10, pady))
+        tk.Label(win, text="Организация:").grid(row=3, column=0, sticky="w", padx=padx, pady=pady)
+        org_var = tk.StringVar(value=self.organization.get().strip())
+        Combobox(win, values=self.store.organizations(), textvariable=org_var, width=37, state="readonly").grid(
+            row=3, column=1, columnspan=2, sticky="w", padx=padx, pady=pady)
+        tk.Label(win, text="Период с:").grid(row=4, column=0, sticky="w", padx=padx, pady=pady)
+        start_entry = tk.Entry(win, width=20)
+        start_entry.grid(row=4, column=1, sticky="w", padx=padx, pady=pady)
+        start_entry.bind("<KeyRelease>", self.format_date)
+        tk.Label(win, text="По:").grid(row=5, column=0, sticky="w", padx=padx, pady=pady)
+        end_entry = tk.Entry(win, width=20)
+        end_entry.grid(row=5, column=1, sticky="w", padx=padx, pady=pady)
+        end_entry.bind("<KeyRelease>", self.format_date)
+
+        tk.Label(win, text="Тип осмотра:").grid(row=6, column=0, sticky="w", padx=padx, pady=(10, pady))
+        type_var = tk.StringVar(value=self.type_var.get())
+        Combobox(win, textvariable=type_var, values=["предварительный", "периодический"], width=37,
+                 state="readonly").grid(row=6, column=1, columnspan=2, sticky="w", padx=padx, pady=(10, pady))
+
+        progress = Progressbar(win, length=360, mode="determinate")
+        progress.grid(row=7, column=0, columnspan=3, padx=padx, pady=(10, 0))
+        status = tk.Label(win, text="")
+        status.grid(row=8, column=0, columnspan=3, sticky="w", padx=padx)
+        start_btn = tk.Button(win, text="Запустить", bg="#4CAF50", fg="white")
+        start_btn.grid(row=9, column=0, columnspan=2, sticky="ew", padx=padx, pady=10)
+        cancel_btn = tk.Button(win, text="Отмена", state="disabled")
+        cancel_btn.grid(row=9, column=2, sticky="ew", padx=padx, pady=10)
+
+        def collect():
+            """(записи, сохранять ли их после выдачи, файл ошибок списка) или None."""
+            if source_var.get() == "roster":
+                path = path_var.get().strip()
+                if not path:
+                    messagebox.showerror("Ошибка ввода", "Выберите файл со списком работников", parent=win)
+                    return None
+                defaults = {
+                    "organization": self.organization.get().strip(),
+                    "ids_date": self.ids_entry.get().strip(),
+                }
+                try:
+                    values_list, errors_path = roster_import.load_roster(path, self.store, defaults)
+                except Exception as e:
+                    messagebox.showerror("Ошибка", f"Не удалось загрузить список:\n{e}", parent=win)
+                    return None
+                return values_list, True, errors_path
+
+            s, e = start_entry.get().strip(), end_entry.get().strip()
+            if not (self.is_valid_date(s) and self.is_valid_date(e)):
+                messagebox.showerror("Ошибка даты", "Даты в формате ДД.ММ.ГГГГ", parent=win)
+                return None
+            d0 = datetime.datetime.strptime(s, "%d.%m.%Y")
+            d1 = datetime.datetime.strptime(e, "%d.%m.%Y")
+            if d1 < d0:
+                messagebox.showerror("Ошибка", "Конечная дата меньше начальной", parent=win)
+                return None
+            org = org_var.get().strip() or None
+            values_list = [dict(record.to_dict(), organization=org_name)
+                           for org_name, record in self.store.iter_period(d0, d1, org)]
+            # записи уже в базе — только печатаем заключения
+            return values_list, False, None
+
+        def start():
+            collected = collect()
+            if collected is None:
                 return
-            paragraph.clear()
-            for part in parts:
-                if part in data_dict:
-                    run = paragraph.add_run(data_dict[part])
-                    run.bold = True
-                else:
-                    paragraph.add_run(part)
-
-        for paragraph in doc.paragraphs:
-            replace_in_paragraph(paragraph, data_dict)
+            values_list, persist, errors_path = collected
+            if not values_list:
+                messagebox.showinfo("Пакетная выдача", "Нет записей для выдачи", parent=win)
+                return
+            type_raw = type_var.get()
+            template_file = render.template_path(self.settings, type_raw, TEMPLATE_PATH)
+            tasks = batch.build_tasks(values_list, type_raw, template_file,
+                                      self.settings.get("save_dir", os.getcwd()))
+            run = batch.BatchRun(tasks)
+            try:
+                run.start()
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось запустить пакетную выдачу:\n{e}", parent=win)
+                return
+            start_btn.config(state="disabled")
+            cancel_btn.config(state="normal", command=run.cancel)
+            progress["maximum"] = len(tasks)
+            win.protocol("WM_DELETE_WINDOW", run.cancel)
+            poll(run, values_list, persist, errors_path)
+
+        def poll(run, values_list, persist, errors_path):
+            done, total = run.poll()
+            progress["value"] = done
+            status.config(text=f"Обработано {done} из {total}" + (" — отмена…" if run.cancelled else ""))
+            if not run.finished:
+                self.after(200, poll, run, values_list, persist, errors_path)
+                return
+            run.close()
+
+            ok = run.succeeded()
+            if persist and ok:
+                # все записи пачки — одной записью в хранилище
+                self.store.save_many([values_list[i] for i in ok])
+                self.data = self.load_data()
+                self.update_comboboxes()
+            failed = run.failed()
+            for i, error in failed:
+                print(f"Пакетная выдача: не удалось создать {run.tasks[i][2]}: {error}")
+
+            message = f"Создано заключений: {len(ok)} из {total}"
+            if run.cancelled:
+                message += "\nВыдача отменена."
+            if failed:
+                message += f"\nС ошибкой: {len(failed)} (подробности в log.txt)"
+            if errors_path:
+                message += f"\nНе загружены строки списка, см. файл:\n{errors_path}"
+            messagebox.showinfo("Пакетная выдача", message, parent=win)
+            win.destroy()
+
+        start_btn.config(command=start)
 
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        replace_in_paragraph(paragraph, data_dict)
+    def get_unique_values(self, field, org_name=None):
+        """Вернёт уникальные значения поля. Если задана org_name — только для этой организации."""
+        if not (org_name and org_name in self.data):
+            org_name = None
+        # готовый отсортированный список из индекса хранилища
+        return self.store.distinct_values(field, org_name)
+
+    def set_combobox_values(self, cb, field, values, org_name=None):
+        """Задаёт список значений combobox'а и индекс для живого поиска по нему."""
+        cb['values'] = values
+        # отсортированный список из индекса хранилища — общий, не изменяется
+        cb.all_values = values
+        key = (field, org_name)
+        index = self.search_indexes.get(key)
+        if index is None:
+            index = self.search_indexes[key] = SubstringIndex(values)
+        else:
+            index.update(values)
+        cb.search_index = index
+        cb.values_key = key
 
     def on_keyrelease(self, event):
         cb = event.widget
-        txt = cb.get().lower()
-        if not hasattr(cb, 'all_values'):
+        txt = cb.get()
+        if not hasattr(cb, 'search_index'):
             cb.all_values = list(cb['values'])
-        if txt == '':
+            cb.search_index = SubstringIndex(cb.all_values)
+        if txt.strip() == '':
             vals = cb.all_values
         else:
-            vals = [v for v in cb.all_values if txt in v.lower()]
+            vals = cb.search_index.search(txt, FILTER_LIMIT)
         cb['values'] = vals
         try:
             cb.tk.call('ttk::combobox::post', cb._w)
@@ -416,10 +721,7 @@ class ConclusionForm(tk.Frame):
 
     def generate_document(self):
         type_raw = self.type_var.get()
-        type_genitive = {
-            "предварительный": "предварительного",
-            "периодический": "периодического"
-        }.get(type_raw, type_raw)
+        type_genitive = render.TYPE_GENITIVE.get(type_raw, type_raw)
 
         form_data = {
             "{type}": type_genitive,
@@ -463,38 +765,42 @@ class ConclusionForm(tk.Frame):
             )
             return
 
-        temp_doc = Document(TEMPLATE_PATH)
-        self.replace_placeholders(temp_doc, form_data)
+        # осмотр уже в базе (например, повторное нажатие после ошибки записи Word-файла) —
+        # спрашиваем до того, как собирать документ
+        existing = self.store.find_visit(form_data["{name}"], form_data["{birthday}"], self.ids_entry.get())
+        if existing:
+            org_name, record = existing
+            if not messagebox.askyesno(
+                "Осмотр уже сохранён",
+                f"{record.name} ({record.birthday}), дата ИДС {record.ids_date}, "
+                f"уже есть в базе: {org_name}.\n\n"
+                "Создать документ ещё раз? Повторно в базу осмотр записан не будет."
+            ):
+                return
 
-        temp_doc_path = tempfile.NamedTemporaryFile(delete=False, suffix=".docx").name
-        temp_doc.save(temp_doc_path)
+        # шаблон разобран один раз за сеанс (и заново, если файл шаблона изменили)
+        template = render.get_template(render.template_path(self.settings, type_raw, TEMPLATE_PATH))
+        doc = template.render(form_data)
 
         if self.combine_all.get():
             combined_filename = os.path.join(
                 self.settings.get("save_dir", os.getcwd()),
                 f"заключения_{datetime.datetime.now().strftime('%d.%m.%Y')}.docx"
             )
-
-            if os.path.exists(combined_filename):
-                try:
-                    master_doc = Document(combined_filename)
-                    composer = Composer(master_doc)
-                    composer.append(Document(temp_doc_path))
-                    composer.save(combined_filename)
-                    self.show_notification(f"Добавлено в файл: {combined_filename}")
-                except Exception as e:
-                    messagebox.showerror("Ошибка", f"Не удалось дописать в файл:\n{e}")
-                    return
+            try:
+                created = self.combined_document(combined_filename).append(doc)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось дописать в файл:\n{e}")
+                return
+            if created:
+                self.show_notification(f"Создан новый файл: {combined_filename}")
+                print("создан новый файл для дозаписи")
             else:
-                # создаём новый файл из temp_doc
-                try:
-                    shutil.copyfile(temp_doc_path, combined_filename)
-                    self.show_notification(f"Создан новый файл: {combined_filename}")
-                    print("создан новый файл для дозаписи")
-                except Exception as e:
-                    messagebox.showerror("Ошибка", f"Не удалось создать файл:\n{e}")
-                    print("файл не создан")
-                    return
+                self.show_notification(f"Добавлено в файл: {combined_filename}")
+            if created or self.combiner.due:
+                self.flush_combined()
+            else:
+                self.schedule_combined_flush()
 
         else:
             filename = os.path.join(
@@ -502,7 +808,7 @@ class ConclusionForm(tk.Frame):
                 f"{form_data['{name}']} - заключение.docx"
             )
             try:
-                temp_doc.save(filename)
+                doc.save(filename)
                 self.show_notification(f"Файл сохранён: {filename}")
             except PermissionError:
                 messagebox.showerror(
@@ -514,7 +820,12 @@ class ConclusionForm(tk.Frame):
                 messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{e}")
                 return
 
-        self.save_record(
+        if existing:
+            self.show_notification("Документ создан повторно, осмотр в базу не записан")
+            self.clear_form()
+            return
+
+        saved = self.save_record(
             form_data["{organization}"],
             form_data["{division}"],
             form_data["{profession}"],
@@ -526,39 +837,93 @@ class ConclusionForm(tk.Frame):
             ids_date=self.ids_entry.get(),
             diagnosis=self.diagnosis.get()
         )
+        # запись уже добавлена в кэш хранилища и его индексы — без перечитывания data.xml
         self.data = self.load_data()
-        self.organization_cb['values'] = sorted(self.data.keys())
-        self.update_comboboxes()
-        try:
-            os.remove(temp_doc_path)
-        except Exception as e:
-            print(f"Не удалось удалить временный файл: {temp_doc_path}\n{e}")
+        if saved:
+            self.update_comboboxes_after_save(saved)
         self.clear_form()
 
+    def combined_document(self, path):
+        """Объединённый файл дня; при смене даты предыдущий записывается и закрывается."""
+        if self.combiner is not None and self.combiner.path != path:
+            self.combiner.close()
+            self.combiner = None
+        if self.combiner is None:
+            self.combiner = combine.DocumentCombiner(path)
+        return self.combiner
+
+    def schedule_combined_flush(self):
+        """Объединённый файл записывается на диск через COMBINE_FLUSH_MS после последнего заключения."""
+        if self._combine_flush_job is not None:
+            self.after_cancel(self._combine_flush_job)
+        self._combine_flush_job = self.after(COMBINE_FLUSH_MS, self.flush_combined)
+
+    def flush_combined(self, closing=False):
+        if self._combine_flush_job is not None:
+            self.after_cancel(self._combine_flush_job)
+        self._combine_flush_job = None
+        if self.combiner is None:
+            return
+        while True:
+            try:
+                if closing:
+                    self.combiner.close()
+                else:
+                    self.combiner.flush()
+                return
+            except PermissionError:
+                message = (f"Не удалось записать объединённый файл:\n{self.combiner.path}\n"
+                           "Закройте его в Word и нажмите «Повторить».")
+            except Exception as e:
+                message = f"Не удалось записать объединённый файл:\n{e}"
+            if not messagebox.askretrycancel("Ошибка записи", message):
+                print(f"Объединённый файл не записан, заключений не сохранено: {self.combiner.pending}")
+                return
+
+    def destroy(self):
+        # при закрытии программы или переключении формы дописываем объединённый файл
+        self.flush_combined(closing=True)
+        super().destroy()
+
+    def field_comboboxes(self):
+        return (("division", self.division_cb), ("profession", self.profession_cb),
+                ("factors", self.factors_cb), ("typework", self.typework_cb),
+                ("diagnosis", self.diagnosis_cb))
+
     def update_comboboxes(self):
         # всегда обновляем список организаций
-        self.organization_cb["values"] = sorted(self.data.keys())
+        self.set_combobox_values(self.organization_cb, "organization", self.store.organizations())
 
+        # значения ТОЛЬКО для выбранной организации;
+        # если организация не выбрана — показываем общие списки (как раньше)
         org = self.organization.get().strip()
-        if org and org in self.data:
-            # значения ТОЛЬКО для выбранной организации
-            self.division_cb["values"] = self.get_unique_values("division", org)
-            self.profession_cb["values"] = self.get_unique_values("profession", org)
-            self.factors_cb["values"] = self.get_unique_values("factors", org)
-            self.typework_cb["values"] = self.get_unique_values("typework", org)
-            self.diagnosis_cb["values"] = self.get_unique_values("diagnosis", org)
-        else:
-            # если организация не выбрана — показываем общие списки (как раньше)
-            self.division_cb["values"] = self.get_unique_values("division")
-            self.profession_cb["values"] = self.get_unique_values("profession")
-            self.factors_cb["values"] = self.get_unique_values("factors")
-            self.typework_cb["values"] = self.get_unique_values("typework")
-            self.diagnosis_cb["values"] = self.get_unique_values("diagnosis")
-
-        # обновляем кеш для живого поиска в combobox'ах
-        for cb in (self.organization_cb, self.division_cb, self.profession_cb, self.factors_cb, self.typework_cb,
-                   self.diagnosis_cb):
-            cb.all_values = list(cb['values'])
+        if not (org and org in self.data):
+            org = None
+        for field, cb in self.field_comboboxes():
+            self.set_combobox_values(cb, field, self.get_unique_values(field, org), org)
+
+    def update_comboboxes_after_save(self, values):
+        """
+        После сохранения одной записи: её новые значения добавляются в индекс живого поиска
+        того combobox'а, где они появились, а список значений переназначается только ему.
+        """
+        org = self.organization.get().strip()
+        if not (org and org in self.data):
+            org = None
+        combos = [("organization", self.organization_cb, None, self.store.organizations)]
+        combos += [(field, cb, org, lambda field=field: self.get_unique_values(field, org))
+                   for field, cb in self.field_comboboxes()]
+        for field, cb, org_name, current_values in combos:
+            if getattr(cb, "values_key", None) != (field, org_name):
+                # например, первая запись новой организации — теперь у неё свой список
+                self.set_combobox_values(cb, field, current_values(), org_name)
+                continue
+            value = values.get(field)
+            if not value or value in cb.search_index:
+                continue
+            cb.search_index.add(value)
+            cb.all_values = current_values()
+            cb['values'] = cb.all_values
 
     def on_organization_selected(self, event):
         self.update_comboboxes()
@@ -0,0 +1,219 @@
+import os
+import copy
+import re
+import shutil
+import threading
+import zipfile
+
+from docx import Document
+from docx.oxml.ns import qn
+from docx.text.run import Run
+
+# Поля шаблона заключения — те же ключи, что form_data в ConclusionForm.generate_document
+PLACEHOLDERS = ("{type}", "{organization}", "{name}", "{birthday}", "{sex}", "{division}",
+                "{profession}", "{factors}", "{typework}", "{ids_date}", "{diagnosis}", "{year}")
+
+_PLACEHOLDER_RE = re.compile(r'(\{.*?\})')
+
+# «{type} медицинского осмотра» — тип осмотра в родительном падеже
+TYPE_GENITIVE = {
+    "предварительный": "предварительного",
+    "периодический": "периодического"
+}
+
+
+def conclusion_data(values, exam_type, year):
+    """Поля шаблона по полям записи (organization, name, birthday, …) и типу осмотра."""
+    data = {"{" + field + "}": values.get(field) or "" for field in
+            ("organization", "name", "birthday", "sex", "division", "profession",
+             "factors", "typework", "ids_date", "diagnosis")}
+    data["{type}"] = TYPE_GENITIVE.get(exam_type, exam_type)
+    data["{year}"] = year
+    return data
+
+
+def iter_template_paragraphs(doc):
+    """Абзацы, в которых ищутся поля: тело документа и ячейки таблиц (как в replace_placeholders)."""
+    yield from doc.paragraphs
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                yield from cell.paragraphs
+
+
+def replace_placeholders(doc, data_dict):
+    """
+    Исходная подстановка полей прямо в документ python-docx: абзац с полем очищается
+    и собирается заново, значение каждого поля — отдельным полужирным прогоном.
+    CompiledTemplate и OoxmlTemplate дают тот же результат без разбора шаблона на каждое заключение.
+    """
+    for paragraph in iter_template_paragraphs(doc):
+        text = ''.join(run.text for run in paragraph.runs)
+        parts = _PLACEHOLDER_RE.split(text)
+        if not any(part in data_dict for part in parts):
+            continue
+        paragraph.clear()
+        for part in parts:
+            if part in data_dict:
+                run = paragraph.add_run(data_dict[part])
+                run.bold = True
+            else:
+                paragraph.add_run(part)
+
+
+def split_placeholders(paragraph, keys):
+    """
+    Переписывает абзац так же, как replace_placeholders: если в нём есть поле,
+    абзац очищается и собирается заново — обычный текст отдельными прогонами,
+    каждое поле своим полужирным прогоном (пока с текстом самого поля).
+    """
+    text = ''.join(run.text for run in paragraph.runs)
+    parts = _PLACEHOLDER_RE.split(text)
+    if not any(part in keys for part in parts):
+        return
+    paragraph.clear()
+    for part in parts:
+        if part in keys:
+            run = paragraph.add_run(part)
+            run.bold = True
+        else:
+            paragraph.add_run(part)
+
+
+class CompiledTemplate:
+    """
+    Шаблон заключения, разобранный один раз: абзацы с полями уже разбиты на прогоны,
+    и известно, какие прогоны тела документа (по порядку) — поля.
+    render копирует готовый документ и меняет текст только этих прогонов.
+    """
+
+    def __init__(self, path, keys=PLACEHOLDERS):
+        self.path = path
+        self.stamp = file_stamp(path)
+        self.keys = frozenset(keys)
+        self.doc = Document(path)
+        for paragraph in iter_template_paragraphs(self.doc):
+            split_placeholders(paragraph, self.keys)
+        # (номер прогона в теле документа, поле)
+        self.slots = [(pos, r.text) for pos, r in enumerate(self.doc.element.body.iter(qn('w:r')))
+                      if r.text in self.keys]
+
+    def render(self, data_dict):
+        """Новый Document с подставленными значениями; поля, которых нет в data_dict, остаются как есть."""
+        doc = copy.deepcopy(self.doc)
+        runs = list(doc.element.body.iter(qn('w:r')))
+        for pos, key in self.slots:
+            if key in data_dict:
+                Run(runs[pos], None).text = data_dict[key]
+        return doc
+
+
+# Символы, недопустимые в XML 1.0 (python-docx на них тоже падает)
+_XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+# Метка поля в сериализованном document.xml: символ из области частного использования и номер поля
+_SLOT_MARK = "\ue000"
+_SLOT_RE = re.compile(("<w:t>" + _SLOT_MARK + "(\\d+)" + _SLOT_MARK + "</w:t>").encode("utf-8"))
+
+
+def run_content_xml(text):
+    """
+    Содержимое прогона для text в том виде, в каком его запишет python-docx (Run.text):
+    табуляция — <w:tab/>, перевод строки — <w:br/>, остальное — <w:t>, с xml:space,
+    если по краям пробелы.
+    """
+    if _XML_INVALID_RE.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    out = []
+    for piece in re.split(r"([\t\r\n])", text):
+        if piece == "\t":
+            out.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            out.append("<w:br/>")
+        elif piece:
+            piece_xml = piece.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            if len(piece.strip()) < len(piece):
+                out.append(f'<w:t xml:space="preserve">{piece_xml}</w:t>')
+            else:
+                out.append(f"<w:t>{piece_xml}</w:t>")
+    return "".join(out).encode("utf-8")
+
+
+class OoxmlTemplate:
+    """
+    Шаблон для пакетной выдачи без объектной модели python-docx: .docx читается как zip.
+    При загрузке абзацы с полями приводятся к виду CompiledTemplate, и word/document.xml
+    сериализуется один раз и режется на неизменные куски между полями.
+    Заключение — склейка кусков с XML подставленных значений; остальные файлы архива
+    переписываются как есть. Если в data_dict есть все поля (как в conclusion_data),
+    document.xml получается побайтно таким же, как у python-docx после replace_placeholders.
+    """
+
+    DOCUMENT_XML = "word/document.xml"
+
+    def __init__(self, path, keys=PLACEHOLDERS):
+        self.path = path
+        self.stamp = file_stamp(path)
+        compiled = CompiledTemplate(path, keys)
+        runs = list(compiled.doc.element.body.iter(qn('w:r')))
+        self.slot_keys = []
+        for n, (pos, key) in enumerate(compiled.slots):
+            Run(runs[pos], None).text = f"{_SLOT_MARK}{n}{_SLOT_MARK}"
+            self.slot_keys.append(key)
+        pieces = _SLOT_RE.split(compiled.doc.part.blob)
+        # pieces: кусок, номер поля, кусок, номер поля, …, кусок
+        self.chunks = pieces[0::2]
+        if [int(n) for n in pieces[1::2]] != list(range(len(self.slot_keys))):
+            raise ValueError(f"Не удалось разметить поля в {self.DOCUMENT_XML}: {path}")
+        self.keys = compiled.keys
+
+    def render_document_xml(self, data_dict):
+        """word/document.xml с подставленными значениями (bytes)."""
+        out = [self.chunks[0]]
+        for key, chunk in zip(self.slot_keys, self.chunks[1:]):
+            out.append(run_content_xml(data_dict[key]) if key in data_dict else run_content_xml(key))
+            out.append(chunk)
+        return b"".join(out)
+
+    def save(self, data_dict, out_path):
+        """Записывает заключение в out_path (путь или открытый двоичный файл)."""
+        document_xml = self.render_document_xml(data_dict)
+        with zipfile.ZipFile(self.path) as zin, zipfile.ZipFile(out_path, "w") as zout:
+            for info in zin.infolist():
+                if info.filename == self.DOCUMENT_XML:
+                    zout.writestr(info, document_xml)
+                else:
+                    with zin.open(info) as src, zout.open(info, "w") as dst:
+                        shutil.copyfileobj(src, dst)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(path, engine=CompiledTemplate):
+    """
+    Шаблон для файла path из кэша процесса (engine — CompiledTemplate или OoxmlTemplate);
+    если файл изменили (другой размер или mtime), шаблон разбирается заново.
+    """
+    path = os.path.abspath(path)
+    with _templates_lock:
+        template = _templates.get((engine, path))
+        if template is None or template.stamp != file_stamp(path):
+            template = _templates[(engine, path)] = engine(path)
+        return template
+
+
+def template_path(settings, exam_type, default_path):
+    """
+    Шаблон для типа осмотра: settings["templates"] = {"предварительный": путь, ...};
+    если для типа ничего не задано или файла нет — default_path.
+    """
+    path = settings.get("templates", {}).get(exam_type)
+    if path and os.path.exists(path):
+        return path
+    return default_path
@@ -0,0 +1,168 @@
+import os
+import re
+import datetime
+import pandas as pd
+
+from conclusion_form import storage
+
+# Окончания отчеств (ими же пользуется ConclusionForm.detect_sex_from_name)
+MALE_PATRONYMIC_SUFFIXES = ("вич", "льич", "ич")
+FEMALE_PATRONYMIC_SUFFIXES = ("вна", "чна", "инична", "овна", "евна", "ична")
+
+# Заголовки столбцов списка работодателя -> поля записи (без учёта регистра и пробелов по краям)
+COLUMN_ALIASES = {
+    "организация": "organization",
+    "фио": "name",
+    "ф.и.о.": "name",
+    "дата рождения": "birthday",
+    "дата рожд.": "birthday",
+    "пол": "sex",
+    "подразделение": "division",
+    "должность": "profession",
+    "профессия": "profession",
+    "факторы": "factors",
+    "вредные факторы": "factors",
+    "виды работ": "typework",
+    "дата идс": "ids_date",
+    "диагноз": "diagnosis",
+}
+
+ROSTER_FIELDS = ("organization", "name", "birthday", "sex", "division", "profession",
+                 "factors", "typework", "ids_date", "diagnosis")
+
+
+def read_roster(path):
+    """Читает список (xlsx/xls/csv) как строки; разделитель csv определяется сам."""
+    if os.path.splitext(path)[1].lower() == ".csv":
+        df = pd.read_csv(path, dtype=str, sep=None, engine="python", encoding="utf-8-sig")
+    else:
+        df = pd.read_excel(path, dtype=str)
+    rename = {}
+    for col in df.columns:
+        key = str(col).strip().lower()
+        if key in ROSTER_FIELDS:
+            rename[col] = key
+        elif key in COLUMN_ALIASES:
+            rename[col] = COLUMN_ALIASES[key]
+    return df.rename(columns=rename)
+
+
+def normalize_dates(series):
+    """Даты в ДД.ММ.ГГГГ (пусто, если не разобрать): и строки, и ячейки-даты Excel."""
+    text = series.fillna("").astype(str).str.strip()
+    # Excel отдаёт даты как '2025-08-04 00:00:00', пользователи пишут '04.08.2025'
+    first = text.str.split().str[0].fillna("")
+    iso = pd.to_datetime(first.where(first.str.match(r"^\d{4}-\d{2}-\d{2}$")), format="%Y-%m-%d", errors="coerce")
+    ru = pd.to_datetime(first.where(first.str.match(r"^\d{1,2}\.\d{1,2}\.\d{4}$")), format="%d.%m.%Y", errors="coerce")
+    return iso.fillna(ru).dt.strftime("%d.%m.%Y").fillna("")
+
+
+def _suffix_pattern(suffixes):
+    return "(?:" + "|".join(re.escape(s) for s in suffixes) + ")$"
+
+
+def detect_sex(names):
+    """Векторный вариант ConclusionForm.detect_sex_from_name: пол по отчеству, по умолчанию «М»."""
+    patronymic = names.fillna("").str.strip().str.split().str[2].fillna("").str.lower()
+    male = patronymic.str.contains(_suffix_pattern(MALE_PATRONYMIC_SUFFIXES), regex=True)
+    female = patronymic.str.contains(_suffix_pattern(FEMALE_PATRONYMIC_SUFFIXES), regex=True) & ~male
+    return female.map({True: "Ж", False: "М"})
+
+
+def prepare_roster(df, defaults):
+    """
+    Приводит список к полям записи и проверяет его.
+    defaults — значения из формы для столбцов, которых нет в списке или которые пусты
+    (обычно организация, дата ИДС).
+    Возвращает (годные строки, ошибочные строки со столбцом «Ошибка»).
+    """
+    df = df.copy()
+    for field in ROSTER_FIELDS:
+        if field not in df.columns:
+            df[field] = ""
+        df[field] = df[field].fillna("").astype(str).str.strip()
+        default = defaults.get(field)
+        if default:
+            df[field] = df[field].mask(df[field] == "", default)
+
+    df["name"] = df["name"].str.split().str.join(" ")
+    raw_birthday, raw_ids = df["birthday"], df["ids_date"]
+    df["birthday"] = normalize_dates(raw_birthday)
+    df["ids_date"] = normalize_dates(raw_ids)
+
+    sex = df["sex"].str.upper().str[:1]
+    df["sex"] = sex.where(sex.isin(["М", "Ж"]), detect_sex(df["name"]))
+
+    errors = pd.Series("", index=df.index)
+    checks = (
+        (df["name"] == "", "нет ФИО; "),
+        (df["organization"] == "", "нет организации; "),
+        (df["birthday"] == "", "дата рождения не в формате ДД.ММ.ГГГГ; "),
+        (df["ids_date"] == "", "дата ИДС не в формате ДД.ММ.ГГГГ; "),
+    )
+    for mask, message in checks:
+        errors = errors.mask(mask, errors + message)
+
+    bad = errors != ""
+    good_rows = df.loc[~bad, list(ROSTER_FIELDS)]
+    bad_rows = df.loc[bad, list(ROSTER_FIELDS)].copy()
+    # в отчёт об ошибках — даты в том виде, в каком они были в файле
+    bad_rows["birthday"] = raw_birthday[bad]
+    bad_rows["ids_date"] = raw_ids[bad]
+    bad_rows["Ошибка"] = errors[bad].str.rstrip("; ")
+    return good_rows, bad_rows
+
+
+def drop_saved_visits(rows, repository):
+    """
+    Отделяет осмотры, которые уже есть в хранилище или повторяются в самом списке
+    (те же ФИО, дата рождения и дата ИДС). Возвращает (новые строки, повторы со столбцом «Ошибка»).
+    """
+    seen = set()
+    errors = {}
+    for index, name, birthday, ids_date in zip(rows.index, rows["name"], rows["birthday"], rows["ids_date"]):
+        if repository.find_visit(name, birthday, ids_date):
+            errors[index] = "осмотр уже есть в базе"
+            continue
+        key = storage.visit_key(name, birthday, ids_date)
+        if key in seen:
+            errors[index] = "повтор в списке"
+        seen.add(key)
+    repeated = rows.index.isin(list(errors))
+    repeated_rows = rows[repeated].copy()
+    repeated_rows["Ошибка"] = pd.Series(errors, dtype=object)
+    return rows[~repeated], repeated_rows
+
+
+def load_roster(path, repository, defaults=None):
+    """
+    Читает и проверяет список, ничего не сохраняя. Ошибочные строки и осмотры, которые
+    уже есть в хранилище, записываются в файл «<имя>_ошибки.xlsx» рядом со списком.
+    Возвращает (годные записи как словари для RecordRepository.save, путь к файлу ошибок или None).
+    """
+    good_rows, bad_rows = prepare_roster(read_roster(path), defaults or {})
+    good_rows, repeated_rows = drop_saved_visits(good_rows, repository)
+    bad_rows = pd.concat([bad_rows, repeated_rows]).sort_index()
+
+    now_str = datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    values_list = [dict(row, date_created=now_str) for row in good_rows.to_dict("records")]
+
+    errors_path = None
+    if not bad_rows.empty:
+        errors_path = os.path.splitext(path)[0] + "_ошибки.xlsx"
+        bad_rows.index = bad_rows.index + 2  # номер строки в исходном файле (с заголовком)
+        bad_rows.to_excel(errors_path, index_label="Строка", sheet_name="Ошибки")
+    return values_list, errors_path
+
+
+def import_roster(path, repository, defaults=None):
+    """
+    Импорт списка работников в хранилище (см. load_roster). Все годные строки
+    сохраняются одной записью (RecordRepository.save_many).
+    Возвращает (сохранённые записи как словари, путь к файлу ошибок или None).
+    """
+    values_list, errors_path = load_roster(path, repository, defaults)
+    ids = repository.save_many(values_list)
+    for values, record_id in zip(values_list, ids):
+        values["id"] = record_id
+    return values_list, errors_path
@@ -0,0 +1,1596 @@
+import os
+import sys
+import atexit
+import json
+import pickle
+import time
+import bisect
+import datetime
+import functools
+import gc
+import queue
+import shutil
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+# Поля записи в том порядке, в каком их пишет save_record
+PERSON_FIELDS = ("organization", "name", "birthday", "sex", "division", "profession",
+                 "factors", "typework", "diagnosis", "ids_date", "id", "date_created")
+
+# Поля, которые попадают в словарь записи (organization — ключ словаря)
+RECORD_FIELDS = ("name", "birthday", "sex", "division", "profession",
+                 "factors", "typework", "id", "ids_date", "diagnosis")
+
+# Поля с повторяющимися значениями: строки интернируются, чтобы тысячи записей
+# ссылались на один объект строки, а не держали каждая свою копию
+INTERNED_FIELDS = frozenset(("sex", "division", "profession", "factors",
+                             "typework", "ids_date", "diagnosis"))
+
+# Работа с файлами хранилищ: запись в журнал и слияние журнала со снимком не должны
+# пересекаться. Берётся только на время файловых операций; под ним _lock не берётся,
+# так что поток записи, держащий _io_lock, не мешает чтению кэша в потоке Tk
+_io_lock = threading.RLock()
+# Кэш и индексы RecordRepository и реестр репозиториев (можно брать _io_lock под ним)
+_lock = threading.RLock()
+
+
+def journal_path(xml_path):
+    """Журнал дописываемых записей лежит рядом со снимком: data.xml -> data.xml.journal"""
+    return xml_path + ".journal"
+
+
+# Форматы даты, которые встречаются в data.xml; время после даты отбрасывается
+IDS_DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_ids_date(ids_date):
+    """
+    Дата ИДС из строки или None, если её не удалось разобрать.
+    Понимает 'ДД.ММ.ГГГГ', 'ДД.ММ.ГГГГ ЧЧ:ММ:СС', 'ГГГГ-ММ-ДД[THH:MM:SS]' и т.п.
+    Дат в архиве мало по сравнению с записями, поэтому результат кэшируется.
+    """
+    ids = (ids_date or "").strip()
+    if not ids:
+        return None
+    ids = ids.replace("T", " ").split()[0]
+    for fmt in IDS_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(ids, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+class Record:
+    """
+    Компактная запись заключения: __slots__ вместо dict и интернированные
+    значения категориальных полей. Читается как словарь — r["name"], r.get("name").
+    ids_date приводится к виду ДД.ММ.ГГГГ, ids_ord — порядковый номер этой даты
+    (date.toordinal). Если дату разобрать не удалось, ids_date остаётся как есть,
+    а ids_ord = None.
+    """
+
+    __slots__ = RECORD_FIELDS + ("ids_ord",)
+
+    def __init__(self, values):
+        intern = sys.intern
+        for field in RECORD_FIELDS:
+            value = values.get(field) or ""
+            if field in INTERNED_FIELDS:
+                value = intern(value)
+            setattr(self, field, value)
+        d_ids = parse_ids_date(self.ids_date)
+        if d_ids:
+            self.ids_date = intern(d_ids.strftime("%d.%m.%Y"))
+            self.ids_ord = d_ids.toordinal()
+        else:
+            self.ids_ord = None
+
+    def to_row(self):
+        """Кортеж значений слотов — для двоичного снимка."""
+        return (self.name, self.birthday, self.sex, self.division, self.profession,
+                self.factors, self.typework, self.id, self.ids_date, self.diagnosis, self.ids_ord)
+
+    @classmethod
+    def from_row(cls, row):
+        """Обратное к to_row: без повторного разбора даты и интернирования."""
+        record = cls.__new__(cls)
+        (record.name, record.birthday, record.sex, record.division, record.profession,
+         record.factors, record.typework, record.id, record.ids_date, record.diagnosis,
+         record.ids_ord) = row
+        return record
+
+    def __getitem__(self, key):
+        if key not in RECORD_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in RECORD_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in RECORD_FIELDS
+
+    def keys(self):
+        return RECORD_FIELDS
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in RECORD_FIELDS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"Record({self.to_dict()!r})"
+
+
+def person_to_record(person):
+    """<person> -> (организация, запись)"""
+    org_name = sys.intern(person.findtext("organization", default=""))
+    record = Record({field: person.findtext(field, default="") for field in RECORD_FIELDS})
+    return org_name, record
+
+
+def make_person(values):
+    """Собирает элемент <person> из словаря {поле: значение} в порядке PERSON_FIELDS."""
+    p = ET.Element("person")
+    for field in PERSON_FIELDS:
+        if field in values:
+            ET.SubElement(p, field).text = values[field]
+    return p
+
+
+class IdGenerator:
+    """
+    Монотонные уникальные id записей: миллисекунды Unix-времени, сдвинутые на 12 бит,
+    плюс счётчик внутри одной миллисекунды. Влезает в 64 бита и всегда больше
+    прежних id (секунды Unix-времени), так что порядок по id сохраняется.
+    """
+
+    def __init__(self):
+        self.last = 0
+        self._lock = threading.Lock()
+
+    def observe(self, record_id):
+        """Учитывает уже существующий id, чтобы новые были строго больше."""
+        try:
+            value = int(record_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if value > self.last:
+                self.last = value
+
+    def next_id(self):
+        with self._lock:
+            self.last = max(int(time.time() * 1000) << 12, self.last + 1)
+            return str(self.last)
+
+
+def serialize_person(person):
+    """
+    Каноническая однострочная запись <person>:
+    поля в порядке PERSON_FIELDS (неизвестные — следом, в исходном порядке),
+    без пробельных узлов между элементами, переводы строк в значениях экранированы.
+    """
+    order = {field: i for i, field in enumerate(PERSON_FIELDS)}
+    children = sorted(person, key=lambda ch: order.get(ch.tag, len(PERSON_FIELDS)))
+    parts = []
+    for ch in children:
+        ch.tail = None
+        parts.append(ET.tostring(ch, encoding="unicode"))
+    line = "<person>" + "".join(parts) + "</person>"
+    return line.replace("\r", "&#13;").replace("\n", "&#10;")
+
+
+def iter_journal(xml_path):
+    """
+    Отдаёт элементы <person> из журнала по одному на строку.
+    Недописанная (оборванная при сбое) строка пропускается.
+    """
+    path = journal_path(xml_path)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield ET.fromstring(line)
+            except ET.ParseError as e:
+                print(f"Пропущена повреждённая строка журнала {path}:{line_no}: {e}")
+
+
+def iter_snapshot(xml_path):
+    """
+    Потоково отдаёт <person> из снимка через iterparse.
+    После того как вызывающий код обработал элемент, он очищается,
+    поэтому в памяти одновременно держится только одна запись.
+    """
+    if not os.path.exists(xml_path):
+        return
+    root = None
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == "person":
+            yield elem
+            elem.clear()
+            # отцепляем уже прочитанные <person> от корня
+            root.clear()
+
+
+def iter_persons(xml_path):
+    """Все <person>: сначала из снимка, затем из журнала."""
+    yield from iter_snapshot(xml_path)
+    yield from iter_journal(xml_path)
+
+
+def iter_records(xml_path):
+    """
+    Генератор (организация, запись) по снимку и журналу.
+    Записи читаются целиком под _io_lock (снимок и журнал — согласованная пара,
+    пока их не сливает compact), а отдаются уже после него: вызывающий, бросивший
+    обход на середине, блокировку не держит.
+    """
+    with _io_lock:
+        records = [person_to_record(person) for person in iter_persons(xml_path)]
+    yield from records
+
+
+def append_records(xml_path, persons):
+    """
+    Дописывает пачку записей в журнал одной записью на диск (один fsync), снимок не трогаем.
+    Перевод строки внутри значений экранируется, чтобы запись занимала ровно одну строку.
+    """
+    text = "".join(serialize_person(person) + "\n" for person in persons)
+    if not text:
+        return
+    with _io_lock:
+        path = journal_path(xml_path)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # предыдущая запись оборвалась — начинаем с новой строки
+                    text = "\n" + text
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_snapshot(xml_path, persons):
+    """
+    Пишет снимок в каноническом виде: по одной записи <person> на строку.
+    Файл собирается во временном файле и подменяется атомарно. Возвращает число записей.
+    """
+    return write_snapshot_lines(xml_path, (serialize_person(person) for person in persons))
+
+
+def write_snapshot_lines(xml_path, lines):
+    """То же, что write_snapshot, но из уже сериализованных serialize_person строк."""
+    tmp_path = xml_path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<data>\n')
+        for line in lines:
+            f.write("  " + line + "\n")
+            count += 1
+        f.write("</data>\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, xml_path)
+    return count
+
+
+def compact(xml_path):
+    """
+    Сливает журнал в снимок data.xml и очищает журнал.
+    Снимок пишется во временный файл и подменяется атомарно,
+    так что при сбое остаются либо старый снимок с журналом, либо новый снимок.
+    Возвращает число перенесённых записей.
+    """
+    with _io_lock:
+        journal_file = journal_path(xml_path)
+        if not os.path.exists(journal_file):
+            return 0
+        moved = sum(1 for _ in iter_journal(xml_path))
+        write_snapshot(xml_path, iter_persons(xml_path))
+        os.remove(journal_file)
+        return moved
+
+
+def assign_unique_ids(xml_path, ids, seen=None):
+    """
+    Миграция: записям с пустым или повторяющимся id выдаёт новые id из ids (IdGenerator).
+    Первая запись с данным id свой id сохраняет. Снимок и журнал сливаются
+    в новый снимок. seen — id, уже занятые в других файлах; пополняется id этого файла.
+    Возвращает число изменённых записей.
+    """
+    if seen is None:
+        seen = set()
+    with _io_lock:
+        taken = set(seen)
+        duplicates = 0
+        for person in iter_persons(xml_path):
+            record_id = person.findtext("id", default="")
+            ids.observe(record_id)
+            if not record_id or record_id in taken:
+                duplicates += 1
+            taken.add(record_id)
+        if not duplicates:
+            seen.update(taken)
+            return 0
+
+        def renumbered():
+            for person in iter_persons(xml_path):
+                id_el = person.find("id")
+                if id_el is None:
+                    id_el = ET.SubElement(person, "id")
+                if not id_el.text or id_el.text in seen:
+                    id_el.text = ids.next_id()
+                seen.add(id_el.text)
+                yield person
+
+        write_snapshot(xml_path, renumbered())
+        if os.path.exists(journal_path(xml_path)):
+            os.remove(journal_path(xml_path))
+        return duplicates
+
+
+def _fingerprint(xml_path):
+    """Все поля всех записей снимка в исходном порядке — для сверки до/после перезаписи."""
+    return [tuple((ch.tag, ch.text or "") for ch in person) for person in iter_snapshot(xml_path)]
+
+
+def _parse_time(xml_path):
+    start = time.perf_counter()
+    ET.parse(xml_path)
+    return time.perf_counter() - start
+
+
+def rewrite_canonical(xml_path):
+    """
+    Разовое сжатие старого data.xml (с наслоениями пустых строк от prettify)
+    в канонический вид. Журнал не трогается. Перед подменой проверяется,
+    что ни одно поле не потерялось. Возвращает статистику:
+    размер до/после в байтах и время разбора до/после в секундах.
+    """
+    with _io_lock:
+        bytes_before = os.path.getsize(xml_path)
+        parse_before = _parse_time(xml_path)
+        before = _fingerprint(xml_path)
+
+        tmp_path = xml_path + ".canonical"
+        write_snapshot(tmp_path, iter_snapshot(xml_path))
+        after = _fingerprint(tmp_path)
+        order = {field: i for i, field in enumerate(PERSON_FIELDS)}
+        if [tuple(sorted(p, key=lambda f: order.get(f[0], len(PERSON_FIELDS)))) for p in before] != after:
+            os.remove(tmp_path)
+            raise ValueError(f"Канонический вид {xml_path} не совпал с исходными данными, файл не изменён")
+
+        os.replace(tmp_path, xml_path)
+        return {
+            "records": len(after),
+            "bytes_before": bytes_before,
+            "bytes_after": os.path.getsize(xml_path),
+            "parse_before": parse_before,
+            "parse_after": _parse_time(xml_path),
+        }
+
+
+class XmlStore:
+    """Записи в data.xml (снимок + журнал)."""
+
+    # отчёты за период RecordRepository считает по своему кэшу
+    serves_periods = False
+    # RecordRepository держит в кэше все записи хранилища
+    partial = False
+
+    def __init__(self, xml_path):
+        self.xml_path = xml_path
+
+    def watched_files(self):
+        """Файлы, по размеру и mtime которых RecordRepository проверяет свежесть кэша."""
+        return (self.xml_path, journal_path(self.xml_path))
+
+    def snapshot_cache_path(self):
+        """Двоичный снимок разобранных записей рядом с data.xml (см. RecordRepository)."""
+        return os.path.splitext(self.xml_path)[0] + ".cache"
+
+    def iter_records(self):
+        return iter_records(self.xml_path)
+
+    def organizations(self):
+        return sorted({org_name for org_name, _ in self.iter_records()})
+
+    def iter_period(self, d0, d1, org_name=None):
+        """(организация, запись) с датой ИДС в [d0, d1]; при org_name — только по этой организации."""
+        o0, o1 = d0.toordinal(), d1.toordinal()
+        for org, record in self.iter_records():
+            if org_name is not None and org != org_name:
+                continue
+            if record.ids_ord is not None and o0 <= record.ids_ord <= o1:
+                yield org, record
+
+    def save(self, values):
+        self.save_many([values])
+
+    def save_many(self, values_list):
+        append_records(self.xml_path, [make_person(values) for values in values_list])
+
+    def compact(self):
+        return compact(self.xml_path)
+
+    def assign_unique_ids(self, ids, seen=None):
+        return assign_unique_ids(self.xml_path, ids, seen)
+
+
+class SqliteStore:
+    """
+    Записи во встроенной базе SQLite рядом с data.xml (data.sqlite).
+    Индексы по организации, нормализованной дате ИДС (ГГГГ-ММ-ДД) и ФИО,
+    поэтому отчёты за период и по организации — выборка по диапазону индекса.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS persons (
+            rowid INTEGER PRIMARY KEY,
+            organization TEXT NOT NULL DEFAULT '',
+            name TEXT NOT NULL DEFAULT '',
+            birthday TEXT NOT NULL DEFAULT '',
+            sex TEXT NOT NULL DEFAULT '',
+            division TEXT NOT NULL DEFAULT '',
+            profession TEXT NOT NULL DEFAULT '',
+            factors TEXT NOT NULL DEFAULT '',
+            typework TEXT NOT NULL DEFAULT '',
+            diagnosis TEXT NOT NULL DEFAULT '',
+            ids_date TEXT NOT NULL DEFAULT '',
+            id TEXT NOT NULL DEFAULT '',
+            date_created TEXT NOT NULL DEFAULT '',
+            ids_norm TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_persons_org_ids ON persons (organization, ids_norm);
+        CREATE INDEX IF NOT EXISTS idx_persons_ids ON persons (ids_norm);
+        CREATE INDEX IF NOT EXISTS idx_persons_name ON persons (name);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    serves_periods = True
+    partial = False
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self._renormalize()
+
+    def _renormalize(self):
+        """Досчитывает ids_norm для строк, дату которых прежний разбор не понял."""
+        with _io_lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT rowid, ids_date FROM persons WHERE ids_norm IS NULL AND ids_date != ''").fetchall()
+            updates = [(self._norm(ids), rowid) for rowid, ids in rows if self._norm(ids)]
+            self.conn.executemany("UPDATE persons SET ids_norm = ? WHERE rowid = ?", updates)
+
+    def watched_files(self):
+        return (self.db_path, self.db_path + "-wal")
+
+    def snapshot_cache_path(self):
+        # SQLite и так читается быстро
+        return None
+
+    @staticmethod
+    def _norm(ids_date):
+        d = parse_ids_date(ids_date)
+        return d.isoformat() if d else None
+
+    def _row(self, values):
+        row = [values.get(field) or "" for field in PERSON_FIELDS]
+        row.append(self._norm(values.get("ids_date")))
+        return row
+
+    def _insert_many(self, rows):
+        cols = ", ".join(PERSON_FIELDS + ("ids_norm",))
+        marks = ", ".join("?" * (len(PERSON_FIELDS) + 1))
+        self.conn.executemany(f"INSERT INTO persons ({cols}) VALUES ({marks})", rows)
+
+    def is_migrated(self):
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone() is not None
+
+    def migrate_from_xml(self, xml_path):
+        """Разовый перенос всех записей из data.xml (снимок + журнал) одной транзакцией."""
+        with _io_lock, self.conn:
+            if self.is_migrated():
+                return 0
+            rows = [self._row({ch.tag: ch.text for ch in reversed(person)})
+                    for person in iter_persons(xml_path)]
+            self._insert_many(rows)
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (xml_path,))
+            return len(rows)
+
+    def _select(self, where="", params=(), order="rowid"):
+        cols = ", ".join(("organization",) + RECORD_FIELDS)
+        cur = self.conn.execute(f"SELECT {cols} FROM persons {where} ORDER BY {order}", params)
+        for row in cur:
+            yield sys.intern(row[0]), Record(dict(zip(RECORD_FIELDS, row[1:])))
+
+    def iter_records(self):
+        return self._select()
+
+    def organizations(self):
+        cur = self.conn.execute("SELECT DISTINCT organization FROM persons ORDER BY organization")
+        return [row[0] for row in cur]
+
+    def iter_period(self, d0, d1, org_name=None):
+        params = [d0.date().isoformat(), d1.date().isoformat()]
+        where = "WHERE ids_norm BETWEEN ? AND ?"
+        if org_name is not None:
+            where = "WHERE organization = ? AND ids_norm BETWEEN ? AND ?"
+            params.insert(0, org_name)
+        return self._select(where, params, order="ids_norm, rowid")
+
+    def save(self, values):
+        self.save_many([values])
+
+    def save_many(self, values_list):
+        """Все записи — одной транзакцией."""
+        with _io_lock, self.conn:
+            self._insert_many([self._row(values) for values in values_list])
+
+    def compact(self):
+        return 0
+
+    def assign_unique_ids(self, ids, seen=None):
+        """
+        Та же миграция id, что и для XML, плюс уникальный индекс по id после неё.
+        seen — id, уже занятые в других хранилищах; пополняется id этой базы.
+        """
+        if seen is None:
+            seen = set()
+        with _io_lock, self.conn:
+            rows = self.conn.execute("SELECT rowid, id FROM persons ORDER BY rowid").fetchall()
+            for _, record_id in rows:
+                ids.observe(record_id)
+            updates = []
+            for rowid, record_id in rows:
+                if not record_id or record_id in seen:
+                    record_id = ids.next_id()
+                    updates.append((record_id, rowid))
+                seen.add(record_id)
+            self.conn.executemany("UPDATE persons SET id = ? WHERE rowid = ?", updates)
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_persons_id ON persons (id)")
+            return len(updates)
+
+
+class PartitionedStore:
+    """
+    Записи в файлах по месяцам даты ИДС: data_parts/2025-08.xml и т.д.
+    (каждый — снимок + журнал, как data.xml), записи без даты — в undated.xml.
+    manifest.json хранит список месяцев и организаций, чтобы не открывать файлы ради них.
+    Форма держит в кэше только последние hot_months месяцев; отчёт за период
+    открывает только месяцы, пересекающиеся с периодом.
+    """
+
+    serves_periods = True
+    partial = True
+    UNDATED = "undated"
+
+    def __init__(self, parts_dir, hot_months=3):
+        self.parts_dir = parts_dir
+        self.hot_months = hot_months
+        self.manifest_path = os.path.join(parts_dir, "manifest.json")
+        os.makedirs(parts_dir, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {"partitions": [], "organizations": []}
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_migrated(self):
+        return os.path.exists(self.manifest_path)
+
+    @classmethod
+    def partition_key(cls, ids_date):
+        d = parse_ids_date(ids_date)
+        return f"{d.year:04d}-{d.month:02d}" if d else cls.UNDATED
+
+    def _part(self, key):
+        return XmlStore(os.path.join(self.parts_dir, key + ".xml"))
+
+    def _dated_keys(self):
+        return sorted(k for k in self.manifest["partitions"] if k != self.UNDATED)
+
+    def _all_keys(self):
+        keys = self._dated_keys()
+        if self.UNDATED in self.manifest["partitions"]:
+            keys.append(self.UNDATED)
+        return keys
+
+    def hot_keys(self):
+        """Последние hot_months месяцев с данными; ошибочные даты из будущего не в счёт."""
+        today = datetime.date.today()
+        current = f"{today.year:04d}-{today.month:02d}"
+        return [k for k in self._dated_keys() if k <= current][-self.hot_months:]
+
+    def migrate_from_xml(self, xml_path):
+        """Разовая раскладка data.xml (снимок + журнал) по месяцам."""
+        with _io_lock:
+            if self.is_migrated():
+                return 0
+            lines = {}
+            organizations = set()
+            for person in iter_persons(xml_path):
+                key = self.partition_key(person.findtext("ids_date", default=""))
+                lines.setdefault(key, []).append(serialize_person(person))
+                organizations.add(person.findtext("organization", default=""))
+            for key, part_lines in lines.items():
+                write_snapshot_lines(self._part(key).xml_path, part_lines)
+            self.manifest = {"partitions": sorted(lines), "organizations": sorted(organizations)}
+            self._write_manifest()
+            return sum(len(part_lines) for part_lines in lines.values())
+
+    def watched_files(self):
+        files = [self.manifest_path]
+        for key in self.hot_keys():
+            files.extend(self._part(key).watched_files())
+        return tuple(files)
+
+    def snapshot_cache_path(self):
+        return os.path.join(self.parts_dir, "hot.cache")
+
+    def iter_records(self):
+        """Записи только горячих (последних) месяцев — то, что нужно форме."""
+        for key in self.hot_keys():
+            yield from self._part(key).iter_records()
+
+    def organizations(self):
+        return self.manifest["organizations"]
+
+    def iter_period(self, d0, d1, org_name=None):
+        first, last = f"{d0.year:04d}-{d0.month:02d}", f"{d1.year:04d}-{d1.month:02d}"
+        for key in self._dated_keys():
+            if first <= key <= last:
+                part = sorted(self._part(key).iter_period(d0, d1, org_name), key=lambda e: e[1].ids_ord)
+                yield from part
+
+    def save(self, values):
+        self.save_many([values])
+
+    def save_many(self, values_list):
+        """Записи раскладываются по месяцам; в каждый файл месяца — одна дозапись."""
+        with _io_lock:
+            by_key = {}
+            for values in values_list:
+                by_key.setdefault(self.partition_key(values.get("ids_date")), []).append(values)
+            changed = False
+            for key, part_values in by_key.items():
+                self._part(key).save_many(part_values)
+                if key not in self.manifest["partitions"]:
+                    self.manifest["partitions"] = sorted(self.manifest["partitions"] + [key])
+                    changed = True
+                new_orgs = {values.get("organization") or "" for values in part_values}
+                new_orgs.difference_update(self.manifest["organizations"])
+                if new_orgs:
+                    # новые списки вместо вставки в старые: манифест читают без блокировки
+                    self.manifest["organizations"] = sorted(set(self.manifest["organizations"]) | new_orgs)
+                    changed = True
+            if changed:
+                self._write_manifest()
+
+    def compact(self):
+        return sum(self._part(key).compact() for key in self._all_keys())
+
+    def assign_unique_ids(self, ids, seen=None):
+        seen = set() if seen is None else seen
+        return sum(self._part(key).assign_unique_ids(ids, seen) for key in self._all_keys())
+
+
+def db_path(xml_path):
+    return os.path.splitext(xml_path)[0] + ".sqlite"
+
+
+def parts_dir(xml_path):
+    return os.path.splitext(xml_path)[0] + "_parts"
+
+
+def open_store(xml_path, backend="xml"):
+    """
+    Хранилище записей по настройке storage_backend: 'xml' (по умолчанию),
+    'sqlite' или 'partitioned' (файлы по месяцам).
+    При первом открытии SQLite или файлов по месяцам в них переносится существующий data.xml;
+    смена настройки в программе идёт через switch_backend.
+    """
+    if backend == "partitioned":
+        store = PartitionedStore(parts_dir(xml_path))
+        if not store.is_migrated():
+            count = store.migrate_from_xml(xml_path)
+            print(f"Разложено по месяцам в {store.parts_dir}: {count} записей")
+        return store
+    if backend == "sqlite":
+        store = SqliteStore(db_path(xml_path))
+        if not store.is_migrated():
+            count = store.migrate_from_xml(xml_path)
+            print(f"Перенесено в {store.db_path}: {count} записей")
+        return store
+    return XmlStore(xml_path)
+
+
+class DateIndex:
+    """
+    Записи, отсортированные по дате ИДС, — по всему архиву и по каждой организации.
+    Выборка за период — два bisect и срез, время зависит от размера ответа, а не архива.
+    """
+
+    def __init__(self, pairs):
+        """pairs — (организация, запись) в порядке хранилища; при равной дате он сохраняется."""
+        entries = [(record.ids_ord, org_name, record) for org_name, record in pairs
+                   if record.ids_ord is not None]
+        entries.sort(key=lambda e: e[0])
+        self._all = ([e[0] for e in entries], [(e[1], e[2]) for e in entries])
+        by_org = {}
+        for e in entries:
+            by_org.setdefault(e[1], []).append(e)
+        self._by_org = {org_name: ([e[0] for e in org_entries], [(e[1], e[2]) for e in org_entries])
+                        for org_name, org_entries in by_org.items()}
+
+    def _org_lists(self, org_name):
+        if org_name not in self._by_org:
+            self._by_org[org_name] = ([], [])
+        return self._by_org[org_name]
+
+    def add(self, org_name, record):
+        """Вставка одной записи с сохранением порядка: O(log n) на поиск места."""
+        if record.ids_ord is None:
+            return
+        for ords, items in (self._all, self._org_lists(org_name)):
+            pos = bisect.bisect_right(ords, record.ids_ord)
+            ords.insert(pos, record.ids_ord)
+            items.insert(pos, (org_name, record))
+
+    def query(self, d0, d1, org_name=None):
+        """[(организация, запись)] с датой ИДС в [d0, d1] (datetime.date), по возрастанию даты."""
+        if org_name is None:
+            ords, items = self._all
+        else:
+            ords, items = self._by_org.get(org_name, ([], []))
+        lo = bisect.bisect_left(ords, d0.toordinal())
+        hi = bisect.bisect_right(ords, d1.toordinal())
+        return items[lo:hi]
+
+
+class DistinctIndex:
+    """
+    Отсортированные уникальные значения полей для выпадающих списков формы
+    (и список организаций) — по всем записям и отдельно по каждой организации.
+    Строится один раз, при сохранении дополняется вставкой через bisect.
+    """
+
+    FIELDS = ("division", "profession", "factors", "typework", "diagnosis")
+
+    def __init__(self, pairs):
+        self._sets = {field: set() for field in self.FIELDS + ("organization",)}
+        self._org_sets = {field: {} for field in self.FIELDS}
+        self.values = {}
+        # поле -> организация -> отсортированные значения
+        self.by_org = {}
+        for org_name, record in pairs:
+            self._sets["organization"].add(org_name)
+            for field in self.FIELDS:
+                value = record.get(field)
+                if value:
+                    self._sets[field].add(value)
+                    self._org_sets[field].setdefault(org_name, set()).add(value)
+        for field, values in self._sets.items():
+            self.values[field] = sorted(values)
+        for field, orgs in self._org_sets.items():
+            self.by_org[field] = {org_name: sorted(values) for org_name, values in orgs.items()}
+
+    def _insert(self, values_set, values_list, value):
+        if value in values_set:
+            return
+        values_set.add(value)
+        bisect.insort(values_list, value)
+
+    def add(self, org_name, record):
+        self._insert(self._sets["organization"], self.values["organization"], org_name)
+        for field in self.FIELDS:
+            value = record.get(field)
+            if value:
+                self._insert(self._sets[field], self.values[field], value)
+                org_set = self._org_sets[field].setdefault(org_name, set())
+                org_list = self.by_org[field].setdefault(org_name, [])
+                self._insert(org_set, org_list, value)
+
+    def get(self, field, org_name=None):
+        if org_name is None:
+            return self.values[field]
+        return self.by_org[field].get(org_name, [])
+
+
+def fold_name(text):
+    """Ключ для поиска по ФИО: без регистра, «ё» как «е», пробелы схлопнуты."""
+    return " ".join(text.casefold().replace("ё", "е").split())
+
+
+class NameIndex:
+    """
+    Отсортированный список (ключ fold_name, ФИО) без повторов — для подсказок в поле ФИО.
+    Поиск по началу — bisect до первого подходящего ключа и k шагов вперёд: O(log n + k).
+    """
+
+    def __init__(self, pairs):
+        self._names = {record.name for _, record in pairs if record.name}
+        self._entries = sorted((fold_name(name), name) for name in self._names)
+
+    def add(self, record):
+        name = record.name
+        if not name or name in self._names:
+            return
+        self._names.add(name)
+        bisect.insort(self._entries, (fold_name(name), name))
+
+    def prefix(self, text, limit=10):
+        """До limit ФИО, начинающихся с text (без учёта регистра и ё/е), по алфавиту."""
+        key = fold_name(text)
+        if not key:
+            return []
+        entries = self._entries
+        result = []
+        pos = bisect.bisect_left(entries, (key,))
+        while pos < len(entries) and len(result) < limit and entries[pos][0].startswith(key):
+            result.append(entries[pos][1])
+            pos += 1
+        return result
+
+
+# Латинские буквы, которые выглядят как русские (смешанная раскладка в одном слове)
+HOMOGLYPHS = str.maketrans("aeopcxykmthb", "аеорсхукмтнв")
+# Транслитерация слов, набранных целиком латиницей: сначала сочетания, потом буквы
+TRANSLIT_PAIRS = (("shch", "щ"), ("sch", "щ"), ("sh", "ш"), ("ch", "ч"), ("zh", "ж"), ("kh", "х"),
+                  ("ts", "ц"), ("yu", "ю"), ("ya", "я"), ("yo", "е"), ("ye", "е"), ("iy", "ий"))
+TRANSLIT = str.maketrans("abvgdezijklmnoprstufhcyw", "абвгдезийклмнопрстуфхцыв")
+
+
+def fold_script(word):
+    """Слово из fold_name -> кириллица: латинские двойники заменяются, латиница транслитерируется."""
+    if word.isascii():
+        for latin, cyrillic in TRANSLIT_PAIRS:
+            word = word.replace(latin, cyrillic)
+        return word.translate(TRANSLIT)
+    return word.translate(HOMOGLYPHS)
+
+
+def edit_distance(a, b, limit):
+    """
+    Расстояние Дамерау — Левенштейна (с перестановкой соседних букв) между a и b;
+    если оно больше limit — возвращает limit + 1, не досчитывая.
+    Считается только полоса шириной limit около диагонали — дальше расстояние всё равно больше.
+    """
+    if a == b:
+        return 0
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    prev2 = None
+    prev = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [over] * (len(b) + 1)
+        if i <= limit:
+            cur[0] = i
+        ca = a[i - 1]
+        best = cur[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            cb = b[j - 1]
+            value = prev[j - 1] if ca == cb else prev[j - 1] + 1
+            if prev[j] + 1 < value:
+                value = prev[j] + 1
+            if cur[j - 1] + 1 < value:
+                value = cur[j - 1] + 1
+            if prev2 is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb and prev2[j - 2] + 1 < value:
+                value = prev2[j - 2] + 1
+            cur[j] = value
+            if value < best:
+                best = value
+        if best > limit:
+            return over
+        prev2, prev = prev, cur
+    return prev[-1] if prev[-1] <= limit else over
+
+
+class FuzzyNameIndex:
+    """
+    Поиск ФИО с опечатками в фамилии (расстояние до MAX_DISTANCE) и со смешением
+    кириллицы и латиницы. Индекс «симметричного удаления»: для каждой фамилии
+    хранятся варианты её первых PREFIX_LENGTH букв без одной и двух букв; запрос
+    порождает такие же варианты и находит кандидатов словарём, а затем кандидаты
+    проверяются точным расстоянием. Время запроса не зависит от числа фамилий.
+    """
+
+    MAX_DISTANCE = 2
+    PREFIX_LENGTH = 7
+
+    def __init__(self, pairs):
+        self._names = set()
+        # фамилия (после fold_script) -> ФИО
+        self._by_surname = {}
+        # вариант с удалёнными буквами -> фамилии
+        self._deletes = {}
+        for _, record in pairs:
+            self.add(record)
+
+    @staticmethod
+    def _words(text):
+        return [fold_script(word) for word in fold_name(text).split()]
+
+    def _variants(self, word):
+        word = word[:self.PREFIX_LENGTH]
+        variants = {word}
+        edge = {word}
+        for _ in range(self.MAX_DISTANCE):
+            edge = {w[:i] + w[i + 1:] for w in edge if len(w) > 1 for i in range(len(w))}
+            variants |= edge
+        return variants
+
+    def add(self, record):
+        name = record.name
+        if not name or name in self._names:
+            return
+        words = self._words(name)
+        if not words:
+            return
+        self._names.add(name)
+        surname = words[0]
+        if surname not in self._by_surname:
+            self._by_surname[surname] = []
+            for variant in self._variants(surname):
+                self._deletes.setdefault(variant, []).append(surname)
+        self._by_surname[surname].append((words, name))
+
+    def search(self, text, limit=10):
+        """
+        До limit ФИО: фамилия отличается от набранной не больше чем на MAX_DISTANCE правок,
+        остальные набранные слова — начала имени и отчества (допускается одна опечатка).
+        Ближайшие по фамилии — первыми.
+        """
+        words = self._words(text)
+        if not words or len(words[0]) < 3:
+            return []
+        query, rest = words[0], words[1:]
+        surnames = set()
+        for variant in self._variants(query):
+            surnames.update(self._deletes.get(variant, ()))
+        found = []
+        memo = {}
+        for surname in surnames:
+            distance = edit_distance(query, surname, self.MAX_DISTANCE)
+            if distance > self.MAX_DISTANCE:
+                continue
+            for words_, name in self._by_surname[surname]:
+                if self._rest_matches(rest, words_[1:], memo):
+                    found.append((distance, name))
+        found.sort()
+        return [name for _, name in found[:limit]]
+
+    @staticmethod
+    def _rest_matches(typed, words, memo):
+        """
+        Набранные имя/отчество совпадают с началом words с точностью до одной опечатки.
+        memo — результаты сравнений в пределах запроса: имён и отчеств немного, они повторяются.
+        """
+        if len(typed) > len(words):
+            return False
+        for typed_word, word in zip(typed, words):
+            key = (typed_word, word)
+            matches = memo.get(key)
+            if matches is None:
+                # слово может быть недописано: сравниваем с началом той же длины (± пропущенная/лишняя буква)
+                size = len(typed_word)
+                matches = memo[key] = word.startswith(typed_word) or any(
+                    edit_distance(typed_word, word[:size + k], 1) <= 1 for k in (-1, 0, 1))
+            if not matches:
+                return False
+        return True
+
+
+class PersonIndex:
+    """
+    История осмотров человека: fold_name(ФИО) -> записи, отсортированные по дате ИДС
+    (записи без даты — в начале, при равной дате сохраняется порядок хранилища).
+    """
+
+    def __init__(self, pairs):
+        self._people = {}
+        for org_name, record in pairs:
+            self.add(org_name, record)
+
+    def add(self, org_name, record):
+        if not record.name:
+            return
+        ords, items = self._people.setdefault(fold_name(record.name), ([], []))
+        ord_ = record.ids_ord if record.ids_ord is not None else 0
+        pos = bisect.bisect_right(ords, ord_)
+        ords.insert(pos, ord_)
+        items.insert(pos, (org_name, record))
+
+    def visits(self, name, birthday=None):
+        """[(организация, запись)] от старых к новым; с birthday — только с этой датой рождения."""
+        _, items = self._people.get(fold_name(name), ((), ()))
+        if birthday:
+            return [item for item in items if item[1].birthday == birthday]
+        return list(items)
+
+
+def visit_key(name, birthday, ids_date):
+    """
+    Ключ осмотра (ФИО, дата рождения, дата ИДС) для поиска повторов:
+    ФИО через fold_name, дата ИДС — порядковый номер, если её удаётся разобрать.
+    """
+    d_ids = parse_ids_date(ids_date)
+    return (fold_name(name or ""), (birthday or "").strip(),
+            d_ids.toordinal() if d_ids else (ids_date or "").strip())
+
+
+class VisitIndex:
+    """
+    Осмотры по ключу visit_key: проверка «такой осмотр уже сохранён» за O(1)
+    и поиск всех повторов в архиве за один проход.
+    """
+
+    def __init__(self, pairs):
+        self._visits = {}
+        for org_name, record in pairs:
+            self.add(org_name, record)
+
+    @staticmethod
+    def _key(record):
+        ids = record.ids_ord if record.ids_ord is not None else record.ids_date.strip()
+        return (fold_name(record.name), record.birthday.strip(), ids)
+
+    def add(self, org_name, record):
+        if not record.name:
+            return
+        self._visits.setdefault(self._key(record), []).append((org_name, record))
+
+    def find(self, name, birthday, ids_date):
+        """Первый сохранённый (организация, запись) с тем же ключом или None."""
+        items = self._visits.get(visit_key(name, birthday, ids_date))
+        return items[0] if items else None
+
+    def duplicates(self):
+        """Группы [(организация, запись)] с одинаковым ключом — по две записи и больше."""
+        return [items for items in self._visits.values() if len(items) > 1]
+
+
+class WriteBehind:
+    """
+    Фоновая запись в хранилище: persist(batch) выполняется в отдельном потоке,
+    окно Tk не ждёт диска. Очередь ограничена — при переполнении submit ждёт.
+    Ошибки записи передаются в on_error(batch, exc) из фонового потока.
+    """
+
+    def __init__(self, persist, on_error, maxsize=256):
+        self._persist = persist
+        self._on_error = on_error
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="medoctor-write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, batch):
+        self._queue.put(batch)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._persist(batch)
+            except Exception as e:
+                try:
+                    self._on_error(batch, e)
+                except Exception as handler_error:
+                    # поток записи не должен умирать: иначе очередь встанет навсегда
+                    print(f"Ошибка в обработчике ошибки записи: {handler_error}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Ждёт, пока всё из очереди будет записано."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+# Ошибки фоновой записи: (batch, exc), batch — список словарей записей, которые не удалось
+# сохранить. Поток записи только кладёт их сюда (вызывать Tk из него нельзя),
+# а главное окно забирает их по таймеру after() в потоке Tk.
+write_errors = queue.Queue()
+
+
+# Версия формата двоичного снимка; менять при изменении Record.to_row
+SNAPSHOT_CACHE_VERSION = 1
+
+
+class RecordRepository:
+    """
+    Общий на процесс кэш записей поверх XmlStore/SqliteStore/PartitionedStore.
+    Разбирает данные один раз; при следующих обращениях сверяет размер и mtime
+    файлов хранилища и перечитывает их, только если файлы изменил кто-то другой.
+    Собственные записи приложения добавляются в кэш на месте.
+    С write_behind=True запись на диск идёт в фоновом потоке (WriteBehind),
+    а кэш обновляется сразу, так что чтение после save уже видит запись.
+    """
+
+    def __init__(self, store, write_behind=False):
+        self.store = store
+        self.data = None
+        self.date_index = None
+        self.distinct = None
+        self.names = None
+        self.people = None
+        self.visits_index = None
+        # нечёткий поиск строится в фоновом потоке (_start_fuzzy_build); пока его нет —
+        # fuzzy_names пуст, а форма показывает подсказки только по началу ФИО
+        self.fuzzy = None
+        # номер загрузки данных: индекс, построенный по прежней загрузке, не ставится
+        self._fuzzy_generation = 0
+        self._fuzzy_building = False
+        self.by_id = {}
+        self.duplicate_ids = 0
+        self.ids = IdGenerator()
+        self.missing_dates = 0
+        self.rejected_dates = 0
+        self._stamp = None
+        self._stale = False
+        self._pending = 0
+        # (организация, запись) в порядке хранилища — для двоичного снимка
+        self._pairs = []
+        self.writer = WriteBehind(self._persist, self._write_failed) if write_behind else None
+
+    def _current_stamp(self):
+        stamp = []
+        for path in self.store.watched_files():
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def load_data(self):
+        """{организация: [записи]} из кэша; перечитывает хранилище, если файлы изменились."""
+        with _lock:
+            if self.data is not None and self._pending:
+                # в очереди есть наши ещё не записанные записи — кэш новее файлов
+                return self.data
+            stamp = self._current_stamp()
+            if self.data is None or self._stale or stamp != self._stamp:
+                # при массовом создании объектов сборщик циклов только мешает — циклов тут нет
+                gc_was_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    self._reload(stamp)
+                finally:
+                    if gc_was_enabled:
+                        gc.enable()
+            return self.data
+
+    def _reload(self, stamp):
+        pairs = self._read_snapshot_cache(stamp)
+        if pairs is None:
+            pairs = list(self.store.iter_records())
+            self._write_snapshot_cache(stamp, pairs)
+        self._pairs = pairs
+        self.data = {}
+        for org_name, record in pairs:
+            self.data.setdefault(org_name, []).append(record)
+        self.date_index = DateIndex(pairs)
+        self.distinct = DistinctIndex(pairs)
+        self.names = NameIndex(pairs)
+        self.people = PersonIndex(pairs)
+        self.visits_index = VisitIndex(pairs)
+        self.fuzzy = None
+        self._fuzzy_generation += 1
+        self._fuzzy_building = False
+        self._index_ids(pairs)
+        self._count_dates(pairs)
+        self._stamp = stamp
+        self._stale = False
+        if self.writer:
+            # общий репозиторий формы — индекс понадобится при вводе ФИО, строим заранее
+            self._start_fuzzy_build()
+
+    def _start_fuzzy_build(self):
+        """Запускает построение FuzzyNameIndex в фоне; вызывается под _lock."""
+        if self.fuzzy is not None or self._fuzzy_building:
+            return
+        self._fuzzy_building = True
+        generation = self._fuzzy_generation
+        pairs = self._pairs[:]
+        threading.Thread(target=self._build_fuzzy, args=(generation, pairs),
+                         name="fuzzy-names", daemon=True).start()
+
+    def _build_fuzzy(self, generation, pairs):
+        started = time.perf_counter()
+        try:
+            fuzzy = FuzzyNameIndex(pairs)
+        except Exception as e:
+            print(f"Не удалось построить нечёткий поиск ФИО: {e}")
+            with _lock:
+                if generation == self._fuzzy_generation:
+                    self._fuzzy_building = False
+            return
+        with _lock:
+            if generation != self._fuzzy_generation:
+                return  # данные за это время перечитаны — построит следующий поток
+            # записи, сохранённые, пока индекс строился
+            for _, record in self._pairs[len(pairs):]:
+                fuzzy.add(record)
+            self.fuzzy = fuzzy
+            self._fuzzy_building = False
+        print(f"Нечёткий поиск ФИО построен за {time.perf_counter() - started:.1f} с")
+
+    def _read_snapshot_cache(self, stamp):
+        """
+        Записи из двоичного снимка (pickle), если он построен по файлам
+        с тем же размером и mtime; иначе None — и данные разбираются заново.
+        """
+        path = self.store.snapshot_cache_path()
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            print(f"Не удалось прочитать {path}, данные будут разобраны заново: {e}")
+            return None
+        if cached.get("version") != SNAPSHOT_CACHE_VERSION or cached.get("stamp") != stamp:
+            return None
+        from_row = Record.from_row
+        return [(org_name, from_row(row)) for org_name, row in cached["rows"]]
+
+    def _write_snapshot_cache(self, stamp, pairs):
+        path = self.store.snapshot_cache_path()
+        if not path:
+            return
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                rows = [(org_name, record.to_row()) for org_name, record in pairs]
+                pickle.dump({"version": SNAPSHOT_CACHE_VERSION, "stamp": stamp, "rows": rows},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Не удалось записать {path}: {e}")
+
+    def _drop_snapshot_cache(self):
+        path = self.store.snapshot_cache_path()
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Не удалось удалить {path}: {e}")
+
+    def _index_ids(self, pairs):
+        """id -> (организация, запись); пустые и повторные id считаются в duplicate_ids."""
+        self.by_id = {}
+        self.duplicate_ids = 0
+        for org_name, record in pairs:
+            self._index_id(org_name, record)
+        if self.duplicate_ids:
+            print(f"Записей с пустым или повторяющимся id: {self.duplicate_ids}")
+
+    def _index_id(self, org_name, record):
+        if not record.id or record.id in self.by_id:
+            self.duplicate_ids += 1
+            return
+        self.by_id[record.id] = (org_name, record)
+        self.ids.observe(record.id)
+
+    def _count_dates(self, pairs):
+        """Считает записи без даты ИДС и с датой, которую не удалось разобрать."""
+        self.missing_dates = self.rejected_dates = 0
+        for _, record in pairs:
+            self._count_date(record)
+        if self.rejected_dates:
+            print(f"Записей с неразобранной датой ИДС: {self.rejected_dates} (не попадут в отчёты за период)")
+
+    def _count_date(self, record):
+        if record.ids_ord is None:
+            if record.ids_date.strip():
+                self.rejected_dates += 1
+            else:
+                self.missing_dates += 1
+
+    def organizations(self):
+        """Отсортированный список организаций (не изменять — общий для всех вызывающих)."""
+        with _lock:
+            self.load_data()
+            if self.store.partial:
+                # в кэше не весь архив: организации из манифеста хранилища плюс те,
+                # что есть в кэше (в том числе ещё не записанные фоновым потоком)
+                return sorted(set(org for org in self.store.organizations() if org)
+                              | set(self.distinct.get("organization")))
+            return self.distinct.get("organization")
+
+    def distinct_values(self, field, org_name=None):
+        """
+        Отсортированные уникальные непустые значения поля по всем записям
+        или только по записям организации org_name (не изменять — список общий).
+        """
+        with _lock:
+            self.load_data()
+            return self.distinct.get(field, org_name)
+
+    def suggest_names(self, text, limit=10):
+        """Подсказки для поля ФИО: до limit имён, начинающихся с text."""
+        with _lock:
+            self.load_data()
+            return self.names.prefix(text, limit)
+
+    def fuzzy_names(self, text, limit=10):
+        """
+        ФИО, похожие на text с учётом опечаток в фамилии и смешения раскладок.
+        Пока индекс строится в фоне — пустой список.
+        """
+        with _lock:
+            self.load_data()
+            if self.fuzzy is None:
+                self._start_fuzzy_build()
+                return []
+            return self.fuzzy.search(text, limit)
+
+    def visits(self, name, birthday=None):
+        """Прошлые осмотры человека [(организация, запись)], от старых к новым."""
+        with _lock:
+            self.load_data()
+            return self.people.visits(name, birthday)
+
+    def find_visit(self, name, birthday, ids_date):
+        """
+        Уже сохранённый осмотр (организация, запись) с теми же ФИО, датой рождения
+        и датой ИДС или None. У PartitionedStore проверяются только загруженные месяцы.
+        """
+        with _lock:
+            self.load_data()
+            return self.visits_index.find(name, birthday, ids_date)
+
+    def duplicate_visits(self):
+        """Группы повторно сохранённых осмотров (по ключу visit_key)."""
+        with _lock:
+            self.load_data()
+            return self.visits_index.duplicates()
+
+    def iter_period(self, d0, d1, org_name=None):
+        if self.store.serves_periods:
+            # у SQLite есть индексы, у файлов по месяцам — манифест; очередь записи сначала сбрасываем
+            self.flush()
+            return self.store.iter_period(d0, d1, org_name)
+        with _lock:
+            self.load_data()
+            return iter(self.date_index.query(d0.date(), d1.date(), org_name))
+
+    def save(self, values):
+        """
+        Сохраняет запись; id, если не задан, выдаётся IdGenerator. Возвращает id.
+        Запись сразу попадает в кэш и индексы, а на диск — синхронно или через очередь.
+        """
+        return self.save_many([values])[0]
+
+    def save_many(self, values_list):
+        """Как save, но пачкой: на диск все записи уходят одной записью. Возвращает список id."""
+        with _lock:
+            # кэш нужен для вставки, а id должен быть больше уже существующих
+            self.load_data()
+            batch = []
+            for values in values_list:
+                if not values.get("id"):
+                    values = dict(values, id=self.ids.next_id())
+                org_name = sys.intern(values.get("organization") or "")
+                record = Record(values)
+                self._count_date(record)
+                self.data.setdefault(org_name, []).append(record)
+                self._pairs.append((org_name, record))
+                self.date_index.add(org_name, record)
+                self.distinct.add(org_name, record)
+                self.names.add(record)
+                self.people.add(org_name, record)
+                self.visits_index.add(org_name, record)
+                if self.fuzzy is not None:
+                    self.fuzzy.add(record)
+                self._index_id(org_name, record)
+                batch.append(values)
+            if not batch:
+                return []
+            if self.writer:
+                self._pending += 1
+        if self.writer:
+            self.writer.submit(batch)
+        else:
+            self._persist(batch)
+        return [values["id"] for values in batch]
+
+    def _persist(self, batch):
+        # сама запись на диск (с fsync) идёт без _lock: поиск по кэшу в потоке Tk её не ждёт;
+        # load_data, пока _pending, кэш не перечитывает
+        try:
+            with _lock:
+                fresh = self._current_stamp() == self._stamp
+            try:
+                self.store.save_many(batch)
+            except Exception:
+                # кэш разошёлся с диском — при следующем чтении верим диску
+                with _lock:
+                    self._stale = True
+                raise
+            with _lock:
+                if fresh:
+                    self._stamp = self._current_stamp()
+                else:
+                    # файлы менял кто-то ещё — перечитаем, когда очередь опустеет
+                    self._stale = True
+        finally:
+            if self.writer:
+                with _lock:
+                    self._pending -= 1
+
+    def _write_failed(self, batch, exc):
+        names = ", ".join(values.get("name", "") for values in batch)
+        print(f"Не удалось сохранить записи ({names}): {exc}")
+        write_errors.put((batch, exc))
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
+    def close(self):
+        """Дописывает очередь и останавливает фоновый поток."""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def compact(self):
+        self.flush()
+        with _lock:
+            fresh = self._current_stamp() == self._stamp
+            moved = self.store.compact()
+            if fresh:
+                self._stamp = self._current_stamp()
+            if (fresh and not self._stale and not self._pending
+                    and self.data is not None and not self.store.partial):
+                # снимок обновлён, а кэш совпадает с диском — сразу кладём рядом двоичную копию
+                self._write_snapshot_cache(self._stamp, self._pairs)
+            else:
+                # кэш мог разойтись с диском (ошибка записи, очередь) — копия по нему была бы неверной
+                self._drop_snapshot_cache()
+            return moved
+
+    def assign_unique_ids(self):
+        """Разовая миграция повторяющихся id; кэш после неё перечитывается."""
+        self.flush()
+        with _lock:
+            changed = self.store.assign_unique_ids(self.ids)
+            if changed:
+                self.data = None
+            return changed
+
+
+_repositories = {}
+
+# Куда можно перейти с data.xml; обратного переноса нет
+MIGRATION_TARGETS = ("sqlite", "partitioned")
+
+
+def migration_target(xml_path, target):
+    """Файл SQLite или папка месяцев, в которые switch_backend переносит записи."""
+    return db_path(xml_path) if target == "sqlite" else parts_dir(xml_path)
+
+
+def switch_backend(xml_path, current, target):
+    """
+    Переход с data.xml на SQLite или файлы по месяцам — только в эту сторону.
+    Записи переносятся из data.xml заново. Если новое хранилище уже есть (остаток
+    прежнего перехода — в нём могут быть записи, которых нет в data.xml), оно не удаляется,
+    а переименовывается в «<имя>.backup-ГГГГММДД-ЧЧММСС»; возвращается путь копии или None.
+    Обратно в data.xml и между SQLite и месяцами записи не переносятся — ValueError.
+    """
+    if target == current:
+        return None
+    if current != "xml" or target not in MIGRATION_TARGETS:
+        raise ValueError(f"Перенос записей из хранилища '{current}' в '{target}' не поддерживается")
+    # дописываем очередь фоновой записи в data.xml и закрываем открытые репозитории
+    abs_path = os.path.abspath(xml_path)
+    with _lock:
+        repositories = [_repositories.pop(key) for key in list(_repositories) if key[0] == abs_path]
+    for repository in repositories:
+        repository.close()
+        if isinstance(repository.store, SqliteStore):
+            repository.store.conn.close()
+    path = migration_target(xml_path, target)
+    backup = None
+    if os.path.exists(path):
+        backup = f"{path}.backup-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        # -wal и -shm переименовываются вместе с базой, иначе копия окажется неполной
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.replace(path + suffix, backup + suffix)
+        print(f"Прежнее хранилище сохранено как {backup}")
+    store = open_store(xml_path, target)
+    if isinstance(store, SqliteStore):
+        store.conn.close()
+    return backup
+
+
+def get_repository(xml_path, backend="xml"):
+    """Один RecordRepository на процесс для каждой пары (data.xml, backend)."""
+    key = (os.path.abspath(xml_path), backend)
+    with _lock:
+        if key not in _repositories:
+            _repositories[key] = RecordRepository(open_store(xml_path, backend), write_behind=True)
+        return _repositories[key]
+
+
+def close_all():
+    """Дописывает очереди всех хранилищ на диск — при выходе из программы."""
+    for repository in list(_repositories.values()):
+        repository.close()
+
+
+atexit.register(close_all)
+
+
+if __name__ == "__main__":
+    # python -m conclusion_form.storage canonical conclusion_form/res/data.xml
+    # python -m conclusion_form.storage unique-ids conclusion_form/res/data.xml [--sqlite]
+    # python -m conclusion_form.storage duplicate-visits conclusion_form/res/data.xml [--sqlite]
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m conclusion_form.storage")
+    parser.add_argument("command", choices=("canonical", "unique-ids", "duplicate-visits"))
+    parser.add_argument("xml_path")
+    parser.add_argument("--sqlite", action="store_true", help="работать с data.sqlite рядом с data.xml")
+    args = parser.parse_args()
+
+    if args.command == "canonical":
+        stats = rewrite_canonical(args.xml_path)
+        speedup = stats["parse_before"] / stats["parse_after"] if stats["parse_after"] else float("inf")
+        print(f"Записей: {stats['records']}")
+        print(f"Размер: {stats['bytes_before']} -> {stats['bytes_after']} байт "
+              f"({stats['bytes_after'] / stats['bytes_before']:.1%})")
+        print(f"Разбор: {stats['parse_before'] * 1000:.1f} -> {stats['parse_after'] * 1000:.1f} мс "
+              f"(быстрее в {speedup:.1f} раз)")
+    elif args.command == "unique-ids":
+        store = open_store(args.xml_path, "sqlite" if args.sqlite else "xml")
+        print(f"Выдано новых id: {store.assign_unique_ids(IdGenerator())}")
+    else:
+        repository = RecordRepository(open_store(args.xml_path, "sqlite" if args.sqlite else "xml"))
+        groups = repository.duplicate_visits()
+        for items in groups:
+            _, first = items[0]
+            print(f"{first.name} {first.birthday}, ИДС {first.ids_date}: {len(items)} записей")
+            for org_name, record in items:
+                print(f"    id={record.id}  {org_name}  {record.profession}")
+        print(f"Групп повторов: {len(groups)}, лишних записей: {sum(len(items) - 1 for items in groups)}")
@@ -5,13 +5,19 @@ import os
 import json
 import datetime
 import calendar
+import multiprocessing
+import queue
 import pandas as pd
 from conclusion_form.form import ConclusionForm
+from conclusion_form import storage
 from search_form.form import SearchForm
 import sys, os, json
 
 APP_NAME = "Medoctor"
 
+# Как часто главное окно проверяет ошибки фоновой записи в базу
+WRITE_ERRORS_POLL_MS = 500
+
 def appdata_dir():
     base = os.environ.get("APPDATA", os.path.expanduser("~"))
     path = os.path.join(base, APP_NAME)
@@ -71,31 +77,15 @@ def save_settings(settings):
     with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
         json.dump(settings, f, indent=2, ensure_ascii=False)
 
-def load_data():
-    import xml.etree.ElementTree as ET
-    if not os.path.exists(XML_PATH):
-        return {}
-    tree = ET.parse(XML_PATH)
-    root = tree.getroot()
-    data = {}
-    for person in root.findall("person"):
-        org_name = person.findtext("organization", default="")
-        record = {
-            "name": person.findtext("name", default=""),
-            "birthday": person.findtext("birthday", default=""),
-            "sex": person.findtext("sex", default=""),
-            "division": person.findtext("division", default=""),
-            "profession": person.findtext("profession", default=""),
-            "factors": person.findtext("factors", default=""),
-            "typework": person.findtext("typework", default=""),
-            "id": person.findtext("id", default=""),
-            "ids_date": person.findtext("ids_date", default=""),
-            "diagnosis": person.findtext("diagnosis", default="")
-        }
-        if org_name not in data:
-            data[org_name] = []
-        data[org_name].append(record)
-    return data
+STORAGE_BACKENDS = {
+    "xml": "Один файл data.xml",
+    "sqlite": "База SQLite (data.sqlite)",
+    "partitioned": "Файлы по месяцам (data_parts)",
+}
+
+def open_store(settings):
+    """Общий кэш записей (data.xml или SQLite — по настройке storage_backend)."""
+    return storage.get_repository(XML_PATH, settings.get("storage_backend", "xml"))
 
 def sanitize_filename(name: str) -> str:
     import re
@@ -181,8 +171,43 @@ class MainApp(tk.Tk):
         self.forms_area = tk.Frame(self)
         self.forms_area.pack(fill="both", expand=True)
         self.show_form("search")
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        # ошибки фоновой записи копятся в очереди storage.write_errors — забираем их из цикла Tk
+        self.poll_write_errors()
 
+    def poll_write_errors(self):
+        while True:
+            try:
+                batch, exc = storage.write_errors.get_nowait()
+            except queue.Empty:
+                break
+            self.show_write_error(batch, exc)
+        self.after(WRITE_ERRORS_POLL_MS, self.poll_write_errors)
+
+    def show_write_error(self, batch, exc):
+        names = ", ".join(values.get("name", "") for values in batch[:5])
+        if len(batch) > 5:
+            names += f" и ещё {len(batch) - 5}"
+        messagebox.showerror(
+            "Ошибка записи",
+            f"Не удалось сохранить записи ({names}) в базу:\n{exc}"
+        )
 
+    def on_close(self):
+        # дописываем очередь фоновой записи, затем переносим журнал в data.xml
+        storage.close_all()
+        store = open_store(self.settings)
+        try:
+            store.compact()
+        except Exception as e:
+            print(f"Не удалось объединить журнал с data.xml: {e}")
+        # разовая миграция: повторяющиеся id (раньше id = секунды) заменяем уникальными
+        if store.duplicate_ids:
+            try:
+                store.assign_unique_ids()
+            except Exception as e:
+                print(f"Не удалось выдать уникальные id: {e}")
+        self.destroy()
 
     def create_menubar(self):
         menubar = tk.Menu(self)
@@ -214,7 +239,7 @@ class MainApp(tk.Tk):
         from openpyxl.utils import get_column_letter
         from tkinter import messagebox
 
-        data = load_data()
+        store = open_store(self.settings)
 
         # --- Окно выбора дат (как в отчёте за месяц) ---
         rpt = tk.Toplevel(self)
@@ -252,10 +277,9 @@ class MainApp(tk.Tk):
             norm = text.replace(';', ',')
             return [p.strip() for p in re.findall(r'\d+(?:\.\d+)?', norm) if p.strip()]
 
-        def calc_age_on(date_birth: str, at_date: str):
+        def calc_age_on(date_birth: str, d: datetime.date):
             try:
                 b = datetime.datetime.strptime(date_birth, "%d.%m.%Y").date()
-                d = datetime.datetime.strptime(at_date, "%d.%m.%Y").date()
             except Exception:
                 return None
             return d.year - b.year - ((d.month, d.day) < (b.month, b.day))
@@ -337,52 +361,43 @@ class MainApp(tk.Tk):
                 return any(p in t for t in terms_set for p in patterns)
 
             summary_rows = []
-            for org_name, recs in data.items():
-                for r in recs:
-                    ids = (r.get("ids_date") or "").strip()
-                    if not ids:
-                        continue
-                    try:
-                        d_ids = datetime.datetime.strptime(ids, "%d.%m.%Y")
-                    except ValueError:
-                        continue
-                    if not (d0 <= d_ids <= d1):
-                        continue
-
-                    age = calc_age_on(r.get("birthday", ""), ids)
-                    base_pt = base_point_for_gender_age(r.get("sex", ""), age)
-
-                    pts = []
-                    pts += parse_points_from_text(r.get("factors", ""))
-                    pts += parse_points_from_text(r.get("typework", ""))
-                    if base_pt:
-                        pts.append(base_pt)
-
-                    items = sorted(set(p for p in pts if p))
-                    subset = df_map[df_map['n'].isin(items)] if items else df_map.iloc[0:0]
-
-                    required_doctors = split_to_set(subset.get('doctors_name', pd.Series(dtype=str)))
-                    required_inspections = split_to_set(subset.get('inspection', pd.Series(dtype=str)))
-                    required_analyses = split_to_set(subset.get('analysis', pd.Series(dtype=str)))
-
-                    row = {
-                        "Дата": ids,
-                        "ФИО": r.get("name", ""),
-                        "Дата рождения": r.get("birthday", ""),
-                        "Организация": org_name,
-                    }
-                    for col, pats in doctor_patterns.items():
-                        row[col] = '+' if contains_any(required_doctors, pats) else ''
-                    for col, pats in test_patterns.items():
-                        has = contains_any(required_inspections, pats) or contains_any(required_analyses, pats)
-                        row[col] = '+' if has else ''
-                    summary_rows.append(row)
+            for org_name, r in store.iter_period(d0, d1):
+                ids = (r.get("ids_date") or "").strip()
+
+                age = calc_age_on(r.get("birthday", ""), datetime.date.fromordinal(r.ids_ord))
+                base_pt = base_point_for_gender_age(r.get("sex", ""), age)
+
+                pts = []
+                pts += parse_points_from_text(r.get("factors", ""))
+                pts += parse_points_from_text(r.get("typework", ""))
+                if base_pt:
+                    pts.append(base_pt)
+
+                items = sorted(set(p for p in pts if p))
+                subset = df_map[df_map['n'].isin(items)] if items else df_map.iloc[0:0]
+
+                required_doctors = split_to_set(subset.get('doctors_name', pd.Series(dtype=str)))
+                required_inspections = split_to_set(subset.get('inspection', pd.Series(dtype=str)))
+                required_analyses = split_to_set(subset.get('analysis', pd.Series(dtype=str)))
+
+                row = {
+                    "Дата": ids,
+                    "ФИО": r.get("name", ""),
+                    "Дата рождения": r.get("birthday", ""),
+                    "Организация": org_name,
+                }
+                for col, pats in doctor_patterns.items():
+                    row[col] = '+' if contains_any(required_doctors, pats) else ''
+                for col, pats in test_patterns.items():
+                    has = contains_any(required_inspections, pats) or contains_any(required_analyses, pats)
+                    row[col] = '+' if has else ''
+                summary_rows.append(row)
 
             if not summary_rows:
                 messagebox.showinfo("Пустой отчет", "Нет записей за выбранный период.")
                 return
 
-            summary_rows.sort(key=lambda x: datetime.datetime.strptime(x["Дата"], "%d.%m.%Y"))
+            # iter_period отдаёт записи уже по возрастанию даты ИДС
             columns = ["Дата", "ФИО", "Дата рождения", "Организация"] + target_cols
             df = pd.DataFrame(summary_rows, columns=columns)
 
@@ -511,15 +526,72 @@ class MainApp(tk.Tk):
                 except Exception as e:
                     messagebox.showerror("Ошибка", f"Не удалось создать папку:\n{e}")
                     return
+            current = self.settings.get("storage_backend", "xml")
+            backend = next(
+                key for key, label in STORAGE_BACKENDS.items() if label == backend_var.get()
+            )
+            if backend != current and not self.switch_backend(current, backend):
+                return
             self.settings["save_dir"] = selected_path
             save_settings(self.settings)
             on_close()
 
         tk.Button(top, text="Выбрать...", command=select_directory).pack(pady=5)
+
+        tk.Label(top, text="Хранилище записей:").pack(anchor="w", padx=10, pady=(5, 0))
+        backend_var = tk.StringVar(
+            value=STORAGE_BACKENDS.get(self.settings.get("storage_backend", "xml"), STORAGE_BACKENDS["xml"])
+        )
+        # с SQLite и файлов по месяцам обратно на data.xml не переходим (storage.switch_backend)
+        Combobox(
+            top,
+            textvariable=backend_var,
+            values=list(STORAGE_BACKENDS.values()),
+            width=47,
+            state="readonly" if self.settings.get("storage_backend", "xml") == "xml" else "disabled"
+        ).pack(padx=10, pady=5)
+
         tk.Button(top, text="Сохранить", command=save_and_close).pack(pady=(5, 10))
 
         tk.Button(top, text="Редактировать приказ 29н…", command=self.open_prikaz_for_edit).pack(pady=(5, 0))
 
+    def switch_backend(self, current, backend):
+        """Переносит записи в новое хранилище после подтверждения; True, если настройка сменилась."""
+        if current != "xml" or backend not in storage.MIGRATION_TARGETS:
+            messagebox.showerror(
+                "Хранилище записей",
+                f"Записи уже перенесены: {STORAGE_BACKENDS.get(current, current)}.\n"
+                "Обратный перенос не поддерживается.",
+                parent=self.settings_window
+            )
+            return False
+        target = storage.migration_target(XML_PATH, backend)
+        existing = ""
+        if os.path.exists(target):
+            existing = (f"\n\nУже есть {target} — в нём могут быть записи, которых нет в data.xml. "
+                        "Он не будет удалён: его переименуют в резервную копию (.backup-дата).")
+        if not messagebox.askyesno(
+            "Хранилище записей",
+            f"Записи из data.xml будут перенесены: {STORAGE_BACKENDS[backend]}.\n"
+            "Дальше программа будет работать только с новым хранилищем, "
+            f"вернуться к data.xml из настроек будет нельзя.{existing}\n\nПеренести записи?",
+            parent=self.settings_window
+        ):
+            return False
+        try:
+            backup = storage.switch_backend(XML_PATH, current, backend)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось перенести записи:\n{e}", parent=self.settings_window)
+            return False
+        if backup:
+            messagebox.showinfo("Хранилище записей", f"Прежнее хранилище сохранено как:\n{backup}",
+                                parent=self.settings_window)
+        self.settings["storage_backend"] = backend
+        save_settings(self.settings)
+        # открытая форма держит старый репозиторий — пересоздаём её на новом хранилище
+        self.show_form("conclusion" if isinstance(self.current_form_frame, ConclusionForm) else "search")
+        return True
+
     def open_prikaz_for_edit(self):
         import shutil
         dst = user_prikaz_path()
@@ -551,14 +623,14 @@ class MainApp(tk.Tk):
 
     # ============ ОТЧЁТ ПО ОРГАНИЗАЦИИ ============
     def report_by_organization(self):
-        data = load_data()
+        store = open_store(self.settings)
         rpt = tk.Toplevel(self)
         rpt.title("Отчет по организации")
         rpt.resizable(False, False)
         padx, pady = 10, 5
         org_var_report = tk.StringVar()
         tk.Label(rpt, text="Организация:").grid(row=0, column=0, sticky="w", padx=padx, pady=pady)
-        org_list = sorted(data.keys())
+        org_list = store.organizations()
         org_cb = Combobox(
             rpt,
             values=org_list,
@@ -603,27 +675,19 @@ class MainApp(tk.Tk):
                 messagebox.showerror("Ошибка", "Конечная дата меньше начальной")
                 return
             rows = []
-            for r in data.get(org_sel, []):
-                ids = r.get("ids_date", "").strip()
-                if not ids:
-                    continue
-                try:
-                    d_ids = datetime.datetime.strptime(ids, "%d.%m.%Y")
-                except ValueError:
-                    continue
-                if d0 <= d_ids <= d1:
-                    rows.append({
-                        "Организация": org_sel,
-                        "ФИО": r["name"],
-                        "Дата рожд.": r["birthday"],
-                        "Пол": r["sex"],
-                        "Подразделение": r["division"],
-                        "Должность": r["profession"],
-                        "Факторы": r["factors"],
-                        "Виды работ": r["typework"],
-                        "Дата ИДС": ids,
-                        "Диагноз": r.get("diagnosis", "")
-                    })
+            for _, r in store.iter_period(d0, d1, org_sel):
+                rows.append({
+                    "Организация": org_sel,
+                    "ФИО": r["name"],
+                    "Дата рожд.": r["birthday"],
+                    "Пол": r["sex"],
+                    "Подразделение": r["division"],
+                    "Должность": r["profession"],
+                    "Факторы": r["factors"],
+                    "Виды работ": r["typework"],
+                    "Дата ИДС": r["ids_date"].strip(),
+                    "Диагноз": r.get("diagnosis", "")
+                })
             if not rows:
                 messagebox.showinfo("Пустой отчет", "Нет записей за выбранный период.")
                 return
@@ -660,7 +724,7 @@ class MainApp(tk.Tk):
 
     # ============ ОТЧЁТ ПО МЕСЯЦУ ============
     def report_by_month(self):
-        data = load_data()
+        store = open_store(self.settings)
         rpt = tk.Toplevel(self)
         rpt.title("Отчет по дате ИДС")
         rpt.resizable(False, False)
@@ -688,28 +752,19 @@ class MainApp(tk.Tk):
             d0 = datetime.datetime.strptime(start, "%d.%m.%Y")
             d1 = datetime.datetime.strptime(end, "%d.%m.%Y")
             rows = []
-            for org_name, recs in data.items():
-                for r in recs:
-                    ids = r.get("ids_date", "").strip()
-                    if not ids:
-                        continue
-                    try:
-                        d_ids = datetime.datetime.strptime(ids, "%d.%m.%Y")
-                    except ValueError:
-                        continue
-                    if d0 <= d_ids <= d1:
-                        rows.append({
-                            "Организация": org_name,
-                            "ФИО": r["name"],
-                            "Дата рожд.": r["birthday"],
-                            "Пол": r["sex"],
-                            "Подразделение": r["division"],
-                            "Должность": r["profession"],
-                            "Факторы": r["factors"],
-                            "Виды работ": r["typework"],
-                            "Дата ИДС": ids,
-                            "Диагноз": r.get("diagnosis", "")
-                        })
+            for org_name, r in store.iter_period(d0, d1):
+                rows.append({
+                    "Организация": org_name,
+                    "ФИО": r["name"],
+                    "Дата рожд.": r["birthday"],
+                    "Пол": r["sex"],
+                    "Подразделение": r["division"],
+                    "Должность": r["profession"],
+                    "Факторы": r["factors"],
+                    "Виды работ": r["typework"],
+                    "Дата ИДС": r["ids_date"].strip(),
+                    "Диагноз": r.get("diagnosis", "")
+                })
             if not rows:
                 messagebox.showinfo("Пустой отчет", "Нет записей за выбранный период.")
                 return
@@ -747,6 +802,8 @@ class MainApp(tk.Tk):
 
 
 if __name__ == "__main__":
+    # пакетная выдача заключений работает в пуле процессов — нужно для сборки PyInstaller
+    multiprocessing.freeze_support()
     app = MainApp()
     setup_logging()
     app.mainloop()